@@ -1,3 +1,4 @@
+import copy
 import json
 import threading
 import os
@@ -26,6 +27,10 @@ _CONFIG = {}
 # Lock for accessing configuration
 _CONFIG_LOCK = threading.Lock()
 
+# Parsed configuration files keyed on (filename, mtime_ns, size).  Reparsing a file that has not changed just hands
+# back a copy of the earlier result.  Guarded by _CONFIG_LOCK.
+_PARSE_CACHE = {}
+
 
 def _get_from_dict(d: dict, key_list: list):
     """Query a value from a nested dictionary using a list of keys."""
@@ -45,6 +50,18 @@ def parse_config_file(filename: str = f"{app_root}/fe_daq.cfg"):
     """
     global _CONFIG, _CONFIG_LOCK
     with _CONFIG_LOCK:
+        try:
+            stat = os.stat(filename)
+        except Exception as exc:
+            logger.error(f"Error reading file '{filename}': {exc}")
+            raise exc
+
+        # Callers are free to modify the configuration, so always give them their own copy of the cached result
+        cache_key = (filename, stat.st_mtime_ns, stat.st_size)
+        if cache_key in _PARSE_CACHE:
+            _CONFIG = copy.deepcopy(_PARSE_CACHE[cache_key])
+            return
+
         try:
             with open(filename, mode="r") as f:
                 # This will choke if a line has a comment after some content.  Comments MUST be on their own line.
@@ -67,7 +84,7 @@ def parse_config_file(filename: str = f"{app_root}/fe_daq.cfg"):
             raise exc
 
         try:
-            _CONFIG = json.loads(jsondata)
+            parsed = json.loads(jsondata)
         except json.decoder.JSONDecodeError as exc:
             start, stop = max(0, exc.pos - 50), min(len(exc.doc), exc.pos + 50)
             logger.error(f"Error parsing config: ... {exc.doc[start:stop]} ...")
@@ -76,6 +93,9 @@ def parse_config_file(filename: str = f"{app_root}/fe_daq.cfg"):
             logger.error(f"Error parsing _CONFIG file '{filename}': {exc}")
             raise exc
 
+        _PARSE_CACHE[cache_key] = parsed
+        _CONFIG = copy.deepcopy(parsed)
+
 
 def clear_config():
     """Clear the configuration"""
@@ -103,6 +123,17 @@ def get_parameter(key: Union[str, List[str], None]) -> Any:
         return _get_parameter(key)
 
 
+def get_parameters(keys: List[Union[str, List[str]]]) -> dict:
+    """Get several _CONFIG parameters under a single lock acquisition.  Thread safe.
+
+    Returns a dictionary keyed by the requested key.  List keys are converted to tuples so they can be dictionary keys.
+    Missing parameters map to None, same as get_parameter.
+    """
+    global _CONFIG_LOCK
+    with _CONFIG_LOCK:
+        return {(key if type(key) == str else tuple(key)): _get_parameter(key) for key in keys}
+
+
 def _get_parameter(key: Union[str, List[str], None]) -> Any:
     """Set an individual config parameter.  If key is None, return entire dictionary.  Not thread safe, internal use."""
     global _CONFIG, _CONFIG_LOCK
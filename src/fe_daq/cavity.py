@@ -3,7 +3,7 @@ import math
 import time
 import traceback
 from datetime import datetime
-from typing import Optional, TextIO, List, Dict, Tuple
+from typing import Optional, TextIO, List, Dict, Tuple, Union
 
 import epics
 import logging
@@ -205,9 +205,14 @@ class Cavity:
                         logger.error(msg)
                         raise RuntimeError(msg)
 
-    def get_jiggled_pset_value(self, delta: float) -> float:
-        """Calculate a random.uniform offset from pset_init of maximum +/- 5.  No changes to EPICS"""
-        return self.pset_init + np.random.uniform(-delta, delta)
+    def get_jiggled_pset_value(self, delta: float, size: Optional[int] = None) -> Union[float, np.ndarray]:
+        """Calculate a random.uniform offset from pset_init of maximum +/- delta.  No changes to EPICS
+
+        Args:
+            delta: The largest offset from pset_init in either direction
+            size: If given, return an array of this many jiggled values from a single draw instead of one float
+        """
+        return self.pset_init + np.random.uniform(-delta, delta, size=size)
 
     def get_low_gset(self):
         """Return the appropriate lowest no FE gradient.  Either the lowest stable or the highest known without FE."""
@@ -10,7 +10,7 @@ import numpy as np
 
 from fe_daq.cavity import Cavity
 from fe_daq import app_config as config
-from fe_daq.detector import NDXDetector, NDXElectrometer
+from fe_daq.detector import NDXDetector, NDXElectrometer, welch_t_stat
 from fe_daq.network import SSLContextAdapter
 from fe_daq.state_monitor import StateMonitor, connection_cb, get_threshold_cb
 
@@ -19,6 +19,19 @@ logger = logging.getLogger(__name__)
 test_prefix = "adamc:"
 
 
+def wait_for_pvs(pvs: List[epics.PV], timeout: float) -> None:
+    """Wait for a group of PVs to connect against one shared deadline.  Raise exception if any fail to connect.
+
+    The PVs started their searches when they were created, so the connections happen in parallel and the total wait
+    is bounded by timeout, not by the number of PVs times timeout.
+    """
+    deadline = time.monotonic() + timeout
+    for pv in pvs:
+        if not pv.connected:
+            if not pv.wait_for_connection(timeout=max(deadline - time.monotonic(), 0)):
+                raise Exception(f"PV {pv.pvname} failed to connect.")
+
+
 class Linac:
     def __init__(self, name: str, prefix: str, linac_pressure_min: float, linac_pressure_max: float,
                  linac_pressure_recovery_margin: float, heater_margin_min: float, heater_recovery_margin: float):
@@ -66,6 +79,16 @@ class Linac:
                 if not pv.wait_for_connection(timeout=timeout):
                     raise Exception(f"PV {pv.pvname} failed to connect.")
 
+    def wait_for_all_connections(self, timeout: float = 10.0) -> None:
+        """Wait for the PVs of this Linac and all of its zones, cavities, and NDX devices to connect.
+
+        All of the PVs share a single deadline.  Raise exception if any fail to connect.
+        """
+        pvs = list(self.pv_list)
+        for group in (self.zones, self.cavities, self.ndx_electrometers, self.ndx_detectors):
+            for obj in group.values():
+                pvs.extend(obj.pv_list)
+        wait_for_pvs(pvs, timeout=timeout)
 
     def check_linac_pressure(self, min_val: Optional[float] = None, max_val: Optional[float] = None) -> Tuple[bool, float]:
         """Check that the linac pressue is not too high.  Use self.linac_pressure_max if threshold is None.
@@ -124,8 +147,15 @@ class Linac:
             raise ValueError("Trying to insert cavity into unrecognized zone")
         self.zones[cavity.zone.name].add_cavity(cavity)
 
-    def jiggle_psets(self, delta: float):
-        """Jiggle PSET values for all cavities in the linac about their starting point. Skip cavities with problems."""
+    def jiggle_psets(self, delta: float, settle_time: float = 0.0):
+        """Jiggle PSET values for all cavities in the linac about their starting point. Skip cavities with problems.
+
+        All of the puts are issued as a single batch and waited on together, so the new PSETs are in place on return.
+
+        Args:
+            delta: The maximum absolute change from the initial PSET value
+            settle_time: How long to monitor the system after the puts have completed.  No monitoring if <= 0.
+        """
 
         pvlist = []
         values = []
@@ -136,6 +166,8 @@ class Linac:
 
         logger.info(f"Jiggling PSETs for {pvlist}")
         epics.caput_many(pvlist, values, wait=True)
+        if settle_time > 0:
+            StateMonitor.monitor(duration=settle_time)
         logger.info("PSETs jiggled")
 
     def restore_psets(self):
@@ -209,19 +241,45 @@ class Linac:
         """Check all fo the NDX detectors for sign of radiation.
 
         Each individual signal is checked.  If any one of them reports a t-stat > t_stat_threshold, return true.
-        Otherwise, return False.
+        Otherwise, return False.  The t-stats for every detector are calculated together by batch_t_stats.
         """
         max_detector = None
-        is_rad = False
         max_t = float("-inf")
-        for ndxd in self.ndx_detectors.values():
-            ir, t_stat = ndxd.is_radiation_above_background(t_stat_threshold=t_stat_threshold)
-            if max_t < t_stat:
-                max_t = t_stat
-                max_detector = ndxd
-            is_rad = is_rad or ir
+        for name, t_stats in self.batch_t_stats().items():
+            # Check both the gamma and neutron signals.  NaNs never compare greater, so they are skipped.
+            for t_stat in t_stats:
+                if max_t < t_stat:
+                    max_t = t_stat
+                    max_detector = self.ndx_detectors[name]
+
+        return max_t > t_stat_threshold, max_t, max_detector
+
+    def batch_t_stats(self) -> Dict[str, Tuple[float, float]]:
+        """Compute the gamma and neutron t-stats for every NDX detector at once.
+
+        All detectors sample together in get_radiation_measurements, so their measurement and background histories
+        have the same length and can be stacked into (detectors x samples) arrays.
+
+        Returns:
+            Dictionary of detector name to a (gamma t-stat, neutron t-stat) tuple
+        """
+        if len(self.ndx_detectors) == 0:
+            return {}
+
+        detectors = list(self.ndx_detectors.values())
+
+        # Detectors with different length histories can't be stacked, so fall back to checking them one at a time
+        lengths = {(len(d.gamma_measurements), len(d.gamma_background), len(d.neutron_measurements),
+                    len(d.neutron_background)) for d in detectors}
+        if len(lengths) > 1:
+            return {d.name: (d.get_gamma_t_stat(), d.get_neutron_t_stat()) for d in detectors}
+
+        g_t = welch_t_stat(np.stack([d.gamma_measurements for d in detectors]),
+                           np.stack([d.gamma_background for d in detectors]), axis=1)
+        n_t = welch_t_stat(np.stack([d.neutron_measurements for d in detectors]),
+                           np.stack([d.neutron_background for d in detectors]), axis=1)
 
-        return is_rad, max_t, max_detector
+        return {d.name: (float(g_t[i]), float(n_t[i])) for i, d in enumerate(detectors)}
 
     def get_linac_energy(self, gsets: Optional[Dict[str, float]] = None) -> float:
         """Calculate the linac energy gain given a dictionary of cavity names and their new gradient.
@@ -468,8 +526,8 @@ class LinacFactory:
         self._setup_cavities(linac)
         self._setup_ndx(linac, electrometer_names=electrometer_names, detector_names=detector_names)
 
-        # Make sure that the linac PVs connect.  The _setup_* methods should do the same.
-        linac.wait_for_connections()
+        # Make sure that all of the PVs connect.  The _setup_* methods should do the same.
+        linac.wait_for_all_connections()
         linac.energy_init = linac.get_linac_energy()
 
         return linac
@@ -640,8 +698,8 @@ class LinacFactory:
         # Here we check that all cavity PVs are able to connect and run any initialization that happens after
         # PVs are connected.
         logger.info("Waiting for cavities to establish EPICS CA connections and setting gset_max.")
+        wait_for_pvs([pv for cavity in linac.cavities.values() for pv in cavity.pv_list], timeout=10.0)
         for cavity in linac.cavities.values():
-            cavity.wait_for_connections()
             cavity.update_gset_max()
 
         # Do a second loop to make sure that all of the connections and callbacks have had time to initialize
@@ -17,6 +17,9 @@ from fe_daq import utils
 
 logger = logging.getLogger(__name__)
 
+# Shared sort key for ordering cavities, detectors, etc. by name
+_NAME = attrgetter('name')
+
 
 def run_find_fe_process(zone: Zone, linac: Linac, no_fe_file: str, fe_onset_file: str) -> None:
     """High level function of measuring field emission onset within a single zone.
@@ -43,7 +46,7 @@ def setup_for_find_fe_process(linac: Linac) -> None:
         raise RuntimeError("User stopped FE onset detection at measure background step.")
 
     # Measure the radiation and save it as the background
-    ndxd_names = [ndxd.name for ndxd in sorted(linac.ndx_detectors.values(), key=attrgetter('name'))]
+    ndxd_names = [ndxd.name for ndxd in sorted(linac.ndx_detectors.values(), key=_NAME)]
     logger.info(f"Starting initial background radiation measurements using {','.join(ndxd_names)}")
     linac.get_radiation_measurements(num_samples=10)
     linac.save_radiation_measurements_as_background()
@@ -79,7 +82,7 @@ def find_no_fe_gsets(zone: Zone, linac: Linac, data_file: str, step_size: float
         # Run until we've maxed out all of the cavities at some no FE gradient.
         while not all(reached_max.values()):
             # Step one cavity up at a time.
-            for cavity in sorted(zone.cavities.values(), key=attrgetter('name')):
+            for cavity in sorted(zone.cavities.values(), key=_NAME):
 
                 # Skip cavities that have already hit the max - includes bypassed cavities
                 if not reached_max[cavity.name]:
@@ -620,7 +623,7 @@ def run_gradient_scan_levelized_walk(linac: Linac, avg_time: float, num_steps: i
 #     linac.set_ndx_for_operations()
 #
 #     logger.info(f"Starting gradient scan of {zone.name}")
-#     for cavity in sorted(zone.cavities.values(), key=attrgetter('name')):
+#     for cavity in sorted(zone.cavities.values(), key=_NAME):
 #         scan_cavity_gradient(cavity=cavity, zone=zone, linac=linac, avg_time=avg_time, settle_time=settle_time,
 #                              n_levels=n_levels, zone_levels=zone_levels, linac_levels=linac_levels)
 #
@@ -1,16 +1,18 @@
+import heapq
 import logging
 import threading
 import time
+from contextlib import contextmanager
 from datetime import datetime
-from typing import Union, Tuple, Optional
+from typing import Union, Tuple, Optional, Callable
 import numpy as np
 
 from fe_daq import utils
 
 logger = logging.getLogger(__name__)
 
-# An array for tracking if a PV has ever connected
-has_connected = []
+# A set for tracking if a PV has ever connected
+has_connected = set()
 has_connected_lock = threading.Lock()
 
 
@@ -27,21 +29,32 @@ def connection_cb(pvname: str = None, conn: bool = None, **kwargs) -> None:
         with has_connected_lock:
             if pvname not in has_connected:
                 first_connect = True
-                has_connected.append(pvname)
+                has_connected.add(pvname)
 
         if not first_connect:
             StateMonitor.pv_reconnected(pvname=pvname)
-            logger.info(f"{pvname} connected.")
+            logger.info("%s connected.", pvname)
     else:
+        # A disconnect means the PV was connected at some point.  Remember that in case clear_state emptied the set,
+        # otherwise the reconnect would look like a first connection and never be reported.
+        with has_connected_lock:
+            has_connected.add(pvname)
         StateMonitor.pv_disconnected(pvname=pvname)
-        logger.error(f"{pvname} disconnected.")
+        logger.error("%s disconnected.", pvname)
 
 
 def get_hv_read_back_cb(target_hv: float, threshold: float = 0.15):
     def _hv_read_back_cb(pvname: str, value: float, **kwargs) -> None:
         """Watch that HV readbacks don't differ from nominal by more than 10%"""
         # Nominally supposed to be ~1000V, but in practice the range is pretty broad
-        if np.abs(target_hv - value) > np.abs(target_hv * threshold):
+        is_bad = bool(np.abs(target_hv - value) > np.abs(target_hv * threshold))
+
+        # Only tell the StateMonitor about changes.  Check its own record rather than caching the last state here, so
+        # that a clear_state is picked up by the next update.
+        if StateMonitor.is_hv_bad(pvname) is is_bad:
+            return
+
+        if is_bad:
             StateMonitor.hv_has_problem(pvname=pvname)
             logger.error(f"{pvname} value is out of spec. ({value} != {target_hv} +/-{np.round(threshold * 100, 0)}%).")
         else:
@@ -106,6 +119,51 @@ def rf_on_cb(pvname: str, value: float, **kwargs) -> None:
         logger.error(f"{pvname} RF is Off ({value})")
 
 
+class ReadWriteLock:
+    """A simple writer-preferring reader-writer lock.  Not reentrant.
+
+    Any number of readers may hold the lock at once, but a writer gets exclusive access.  Waiting writers block new
+    readers so that a steady stream of reads cannot starve the EPICS callbacks that update state.
+    """
+
+    def __init__(self):
+        self.__cond = threading.Condition(threading.Lock())
+        self.__readers = 0
+        self.__writer = False
+        self.__writers_waiting = 0
+
+    @contextmanager
+    def read_lock(self):
+        """Context manager for shared, read-only access."""
+        with self.__cond:
+            while self.__writer or self.__writers_waiting > 0:
+                self.__cond.wait()
+            self.__readers += 1
+        try:
+            yield
+        finally:
+            with self.__cond:
+                self.__readers -= 1
+                if self.__readers == 0:
+                    self.__cond.notify_all()
+
+    @contextmanager
+    def write_lock(self):
+        """Context manager for exclusive access."""
+        with self.__cond:
+            self.__writers_waiting += 1
+            while self.__writer or self.__readers > 0:
+                self.__cond.wait()
+            self.__writers_waiting -= 1
+            self.__writer = True
+        try:
+            yield
+        finally:
+            with self.__cond:
+                self.__writer = False
+                self.__cond.notify_all()
+
+
 # A quick and dirty attempt at a singleton in Python.
 class StateMonitor:
     """A simple class for tracking the state of CEBAF as it relates to RF PVs.  Meant as a singleton.
@@ -114,8 +172,20 @@ class StateMonitor:
     private versions do not.  This helps to avoid deadlocks and makes clear your locking intent.
     """
 
-    # EPICS CA callbacks can happen in threads.  Synchronize access to these counters
-    __state_lock = threading.Lock()
+    # EPICS CA callbacks can happen in threads.  Synchronize access to these counters.  Callbacks write state while the
+    # monitoring thread mostly reads it, so let readers share the lock.
+    __state_lock = ReadWriteLock()
+
+    # Used to wake up monitor() as soon as a callback reports a problem.  Only notify after releasing __state_lock.
+    __state_cv = threading.Condition()
+
+    # Number of problems reported so far.  Guarded by __state_cv.  monitor() compares against the count it last saw, so
+    # a problem reported while it was busy checking the state still wakes it.
+    __problem_count = 0
+
+    # Notified after every state change, good or bad, so that callers can wait for a specific state in wait_for.  Only
+    # notify after releasing __state_lock.
+    __update_cv = threading.Condition()
 
     # Dictionary of known PVs, RF status, and NDX HV status
     __pv_connected = {}
@@ -123,17 +193,36 @@ class StateMonitor:
     __hv_bad = {}
     __threshold_exceeded = {}
 
+    # Names of PVs currently exceeding their thresholds.  The dictionary above holds the (threshold, value, kind)
+    # details that are only needed when reporting a problem.
+    __threshold_exceeded_pvs = set()
+
+    # Names of PVs currently in a bad state.  Updated on state transitions so that the counts are cheap to query and
+    # error reporting does not have to scan every known PV.
+    __disconnected_pvs = set()
+    __rf_off_pvs = set()
+    __hv_bad_pvs = set()
+
     @classmethod
     def clear_state(cls):
-        with cls.__state_lock:
+        with cls.__state_lock.write_lock():
             cls.__pv_connected = {}
             cls.__rf_on = {}
             cls.__hv_bad = {}
             cls.__threshold_exceeded = {}
+            cls.__threshold_exceeded_pvs = set()
+            cls.__disconnected_pvs = set()
+            cls.__rf_off_pvs = set()
+            cls.__hv_bad_pvs = set()
+
+        # Forget which PVs have connected too, so that repeated resets don't grow this forever
+        with has_connected_lock:
+            has_connected.clear()
+        cls.__notify_update()
 
     @classmethod
     def output_state(cls) -> str:
-        with cls.__state_lock:
+        with cls.__state_lock.read_lock():
             out = cls.__output_state()
         return out
 
@@ -150,105 +239,148 @@ __threshold_exceeded: {ascii(cls.__threshold_exceeded)}"""
 
     @classmethod
     def get_disconnected_pv_count(cls):
-        with cls.__state_lock:
+        with cls.__state_lock.read_lock():
             out = cls.__get_disconnected_pv_count()
         return out
 
     @classmethod
     def get_hv_bad_count(cls):
-        with cls.__state_lock:
+        with cls.__state_lock.read_lock():
             out = cls.__get_hv_bad_count()
         return out
 
+    @classmethod
+    def is_hv_bad(cls, pvname) -> Optional[bool]:
+        """Return the recorded HV state (True == bad) of pvname, or None if none has been reported since clear_state.
+
+        This runs on every HV readback, so it skips the state lock.  A single dict get is atomic, and clear_state
+        replaces the dictionary rather than emptying it, so this always sees a consistent entry.
+        """
+        return cls.__hv_bad.get(pvname)
+
     @classmethod
     def get_no_rf_cavity_count(cls):
-        with cls.__state_lock:
+        with cls.__state_lock.read_lock():
             out = cls.__get_rf_off_count()
         return out
 
     @classmethod
     def threshold_exceeded(cls, pvname: str, threshold: float, value: float, kind: str) -> None:
         """Track when a PV's threshold has been exceeded."""
-        with cls.__state_lock:
+        with cls.__state_lock.write_lock():
+            cls.__threshold_exceeded_pvs.add(pvname)
             cls.__threshold_exceeded[pvname] = (threshold, value, kind)
             logger.info(f"{pvname} exceed threshold ({value} {kind} {threshold}).")
+        cls.__notify_problem()
+        cls.__notify_update()
 
     @classmethod
     def threshold_recovered(cls, pvname: str, low: float, high: float, value: float) -> None:
         """Track when a PV's threshold has been exceeded."""
-        with cls.__state_lock:
-            if (cls.__get_threshold_exceeded_count() > 0) and (pvname in cls.__threshold_exceeded.keys()):
-                del cls.__threshold_exceeded[pvname]
+        with cls.__state_lock.write_lock():
+            cls.__threshold_exceeded.pop(pvname, None)
+            cls.__threshold_exceeded_pvs.discard(pvname)
         logger.info(f"{pvname} is back within threshold ({low} < {value} < {high})")
+        cls.__notify_update()
 
     @classmethod
     def pv_disconnected(cls, pvname) -> None:
         """Increment the disconnected PV counter."""
-        with cls.__state_lock:
+        with cls.__state_lock.write_lock():
+            cls.__disconnected_pvs.add(pvname)
             cls.__pv_connected[pvname] = False
+        cls.__notify_problem()
+        cls.__notify_update()
 
     @classmethod
     def pv_reconnected(cls, pvname) -> None:
         """Decrement the disconnected PV counter."""
-        with cls.__state_lock:
+        with cls.__state_lock.write_lock():
+            cls.__disconnected_pvs.discard(pvname)
             cls.__pv_connected[pvname] = True
+        cls.__notify_update()
 
     @classmethod
     def hv_has_problem(cls, pvname) -> None:
         """Decrement the disconnected PV counter."""
-        with cls.__state_lock:
+        with cls.__state_lock.write_lock():
+            cls.__hv_bad_pvs.add(pvname)
             cls.__hv_bad[pvname] = True
+        cls.__notify_problem()
+        cls.__notify_update()
 
     @classmethod
     def hv_good(cls, pvname) -> None:
         """Decrement the disconnected PV counter."""
-        with cls.__state_lock:
+        with cls.__state_lock.write_lock():
+            cls.__hv_bad_pvs.discard(pvname)
             cls.__hv_bad[pvname] = False
+        cls.__notify_update()
+
+    @classmethod
+    def __notify_problem(cls) -> None:
+        """Wake up any threads waiting in monitor() so that they can check the new state."""
+        with cls.__state_cv:
+            cls.__problem_count += 1
+            cls.__state_cv.notify_all()
+
+    @classmethod
+    def __notify_update(cls) -> None:
+        """Wake up any threads waiting in wait_for so that they can re-evaluate their condition."""
+        with cls.__update_cv:
+            cls.__update_cv.notify_all()
+
+    @classmethod
+    def wait_for(cls, predicate: Callable[[], bool], timeout: Optional[float] = None) -> bool:
+        """Wait until predicate returns True, re-checking it every time the state changes.
+
+        Args:
+            predicate: Called with no arguments.  May use the public StateMonitor methods, e.g. daq_good.
+            timeout: Maximum number of seconds to wait.  None waits forever.
+
+        Returns:
+            The last value of predicate, i.e., False if the timeout expired first.
+        """
+        with cls.__update_cv:
+            return cls.__update_cv.wait_for(predicate, timeout=timeout)
 
     @classmethod
     def __get_disconnected_pv_count(cls):
-        count = 0
-        for conn in cls.__pv_connected.values():
-            if not conn:
-                count += 1
-        return count
+        return len(cls.__disconnected_pvs)
 
     @classmethod
     def __get_rf_off_count(cls):
-        count = 0
-        for rf_on in cls.__rf_on.values():
-            if not rf_on:
-                count += 1
-        return count
+        return len(cls.__rf_off_pvs)
 
     @classmethod
     def __get_hv_bad_count(cls):
-        count = 0
-        for hv_bad in cls.__hv_bad.values():
-            if hv_bad:
-                count += 1
-        return count
+        return len(cls.__hv_bad_pvs)
 
     @classmethod
     def __get_threshold_exceeded_count(cls):
-        return len(cls.__threshold_exceeded.keys())
+        return len(cls.__threshold_exceeded_pvs)
 
     @classmethod
     def rf_turned_off(cls, pvname) -> None:
         """Increment the RF off counter."""
-        with cls.__state_lock:
+        with cls.__state_lock.write_lock():
+            cls.__rf_off_pvs.add(pvname)
             cls.__rf_on[pvname] = False
+        cls.__notify_problem()
+        cls.__notify_update()
 
     @classmethod
     def rf_turned_on(cls, pvname) -> None:
         """Decrement the RF off counter."""
-        with cls.__state_lock:
+        with cls.__state_lock.write_lock():
+            cls.__rf_off_pvs.discard(pvname)
             cls.__rf_on[pvname] = True
+        cls.__notify_update()
 
     @classmethod
     def daq_good(cls) -> bool:
         """Is DAQ good to proceed.  True if we should take data, false if not."""
-        with cls.__state_lock:
+        with cls.__state_lock.read_lock():
             return cls.__daq_good()
 
     @classmethod
@@ -268,13 +400,25 @@ __threshold_exceeded: {ascii(cls.__threshold_exceeded)}"""
             duration: How long should we monitor for in seconds?  If none, do one check and exit.
             user_input: Should we wait on user input (True, default) or immediately raise an exception
         """
-        # If we're given a settle time, then sleep in small increments until that time is up.  Check the state after
-        # waking up.
+        # If we're given a settle time, then sleep until that time is up.  Callbacks that report a problem wake us
+        # early so that we can check the state right away instead of at the end.
+        # Time the wait with the monotonic clock so wall clock adjustments can't stretch or cut it short.  The
+        # datetimes are only for reporting.
         start = datetime.now()
         if duration is not None and duration > 0.0:
+            deadline = time.monotonic() + duration
+            # Note the problem count before each check so that a problem reported during the check isn't missed
+            with cls.__state_cv:
+                seen = cls.__problem_count
             cls.check_state(user_input=user_input)
-            while (datetime.now() - start).total_seconds() < duration:
-                time.sleep(0.05)
+            remaining = deadline - time.monotonic()
+            while remaining > 0:
+                with cls.__state_cv:
+                    problem = cls.__state_cv.wait_for(lambda: cls.__problem_count != seen, timeout=remaining)
+                    seen = cls.__problem_count
+                if problem:
+                    cls.check_state(user_input=user_input)
+                remaining = deadline - time.monotonic()
 
         cls.check_state(user_input=user_input)
         end = datetime.now()
@@ -291,72 +435,64 @@ __threshold_exceeded: {ascii(cls.__threshold_exceeded)}"""
         Raises:
             RuntimeError:  Bad state is found and users requests program exists.
         """
-        with cls.__state_lock:
+        # Build the error while holding the lock, but don't hold it while we wait on the user.  Otherwise every EPICS
+        # callback would block until the user responded.
+        error = None
+        with cls.__state_lock.read_lock():
             try:
                 if not cls.__daq_good():
                     n_dps = cls.__get_disconnected_pv_count()
                     n_no_rf = cls.__get_rf_off_count()
                     n_hv = cls.__get_hv_bad_count()
                     n_threshold = cls.__get_threshold_exceeded_count()
+                    # Only report the first few bad PVs
                     if n_dps > 0:
                         pvs = ""
-                        count = 0
-                        for pv_name in sorted(cls.__pv_connected.keys()):
-                            if count >= 3:
-                                pvs += "...\n"
-                                break
-                            if not cls.__pv_connected[pv_name]:
-                                count += 1
-                                pvs += f"{pv_name} disconnected\n"
+                        for pv_name in heapq.nsmallest(3, cls.__disconnected_pvs):
+                            pvs += f"{pv_name} disconnected\n"
+                        if n_dps > 3:
+                            pvs += "...\n"
                         raise RuntimeError(f"StateMonitor detected {n_dps} disconnected PVs.\n{pvs}")
                     elif n_no_rf > 0:
                         pvs = ""
-                        count = 0
-                        for pv_name in sorted(cls.__rf_on.keys()):
-                            if count >= 3:
-                                pvs += "...\n"
-                                break
-                            if not cls.__rf_on[pv_name]:
-                                count += 1
-                                pvs += f"{pv_name} has RF off\n"
+                        for pv_name in heapq.nsmallest(3, cls.__rf_off_pvs):
+                            pvs += f"{pv_name} has RF off\n"
+                        if n_no_rf > 3:
+                            pvs += "...\n"
                         raise RuntimeError(f"StateMonitor detected {n_no_rf} cavities without RF on")
                     elif n_hv > 0:
                         pvs = ""
-                        count = 0
-                        for pv_name in sorted(cls.__hv_bad.keys()):
-                            if count >= 3:
-                                pvs += "...\n"
-                                break
-                            if cls.__hv_bad[pv_name]:
-                                count += 1
-                                pvs += f"{pv_name}: Bad high voltage.\n"
+                        for pv_name in heapq.nsmallest(3, cls.__hv_bad_pvs):
+                            pvs += f"{pv_name}: Bad high voltage.\n"
+                        if n_hv > 3:
+                            pvs += "...\n"
                         raise RuntimeError(f"StateMonitor detected {n_hv} NDX with bad HV.")
                     elif n_threshold > 0:
                         pvs = ""
-                        count = 0
-                        for pv_name in sorted(cls.__threshold_exceeded.keys()):
-                            if count >= 3:
-                                pvs += "...\n"
-                                break
-                            count += 1
+                        for pv_name in heapq.nsmallest(3, cls.__threshold_exceeded_pvs):
                             (threshold, value, kind) = cls.__threshold_exceeded[pv_name]
                             pvs += f"{pv_name}: {value} {kind} {threshold} (threshold).\n"
+                        if n_threshold > 3:
+                            pvs += "...\n"
                         raise RuntimeError(f"StateMonitor detected {n_threshold} PVs exceeding threshold.\n{pvs}")
                     else:
                         raise RuntimeError(f"StateMonitor detected something wrong.\n{cls.__output_state()}")
             except Exception as ex:
-                msg = f"StateMonitor found error.\n{ex}"
-                logger.error(msg)
-                if user_input:
-                    do_continue = utils.user_alert_scan_paused(msg)
-                    if not do_continue:
-                        logger.info("Exiting after error based on user response.")
-                        raise RuntimeError("User indicated unrecoverable error.")
-
-                    # response = input(f"{msg}\nContinue (n|Y): ").lower().lstrip()
-                    # if not response.startswith('y'):
-                    #     logger.info("Exiting after error based on user response.")
-                    #     raise RuntimeError("User indicated unrecoverable error.")
-                else:
-                    logger.info("No user interaction requested on check_state exception.")
-                    raise ex
+                error = ex
+
+        if error is not None:
+            msg = f"StateMonitor found error.\n{error}"
+            logger.error(msg)
+            if user_input:
+                do_continue = utils.user_alert_scan_paused(msg)
+                if not do_continue:
+                    logger.info("Exiting after error based on user response.")
+                    raise RuntimeError("User indicated unrecoverable error.")
+
+                # response = input(f"{msg}\nContinue (n|Y): ").lower().lstrip()
+                # if not response.startswith('y'):
+                #     logger.info("Exiting after error based on user response.")
+                #     raise RuntimeError("User indicated unrecoverable error.")
+            else:
+                logger.info("No user interaction requested on check_state exception.")
+                raise error
@@ -1,13 +1,16 @@
+import functools
+import heapq
+import json
 import logging
 import time
-from datetime import datetime, timedelta
-from typing import List, Dict
+from typing import List, Dict, Optional, Tuple
 
 import epics
 from fe_daq.network import SSLContextAdapter
-import threading
 import requests
 import os
+import queue
+import threading
 from epics import PV, caput_many
 import numpy as np
 
@@ -18,72 +21,101 @@ os.environ['EPICS_CA_ADDR_LIST'] = 'localhost'
 
 # Master set of available PVs.  It's global, so be careful.
 PVs = {}
-fe_onset = {}
+# Per-cavity state used by gset_cb, indexed by an integer cavity ID that is handed to the callback.  Saves hashing
+# the PV name on every GSET update.
+fe_onset = []  # type: List[float]  # The GSET above which a cavity field emits
+gmes_names = []  # type: List[str]  # The GMES PV name matching each cavity's GSET
 prefix = "adamc:"
-fe_active = {}  # Is a cavity field emitting? [str(pvname), bool].  Managed by gset_cb
+fe_active = []  # type: List[Optional[bool]]  # Is a cavity field emitting?  None until its first GSET update.
+num_fe_active = 0  # How many entries in fe_active are True.  Managed by gset_cb
+fe_active_lock = threading.Lock()  # Guards fe_active and num_fe_active against concurrent callbacks
+cur_pvs = []  # type: List[PV]  # The NDX gCur/nCur PVs.  update_ndx only needs to touch these
 JT_valves = {}  # type: Dict[str, JTValve]
+# Min-heap of (recovery deadline, zone, JTValve) for the valves currently waiting to recover.  Zone breaks ties.
+jt_recovery_heap = []  # type: List[Tuple[float, str, JTValve]]
 
-# Gets changed in main and callback threads.  Use a lock to ensure that we get consistent sets of PVs during callbacks
-# or other functions.  This looks unnecessary at first glance.
-gc_lock = threading.Lock()
-gset_changed = False  # Has an RF PV change over last iteration?  We'll use this to update radiation PVs
-gmes_changed = {}  # A dictionary of the cavities that have had a gradient change and the new gradient
+# Filled by callback threads and drained by the main loop.  SimpleQueue is thread-safe, so no lock is needed.
+gmes_changed = queue.SimpleQueue()  # (GMES PV name, new gradient) for cavities that have had a gradient change
 cavity_lengths = {}  # Used to track the length of each cavity by name
+emes_gmes_names = []  # type: List[str]  # GMES PV names of the NL cavities followed by the SL cavities
+emes_lengths = {}  # type: Dict[str, np.ndarray]  # Linac ('1' or '2') to its cavity lengths, in emes_gmes_names order
 
 # How the largest amount of noise in the gradient readback
 max_gradient_noise = 0.05
 
-
-def rf_zone_to_ced_zone(zone):
-    names = {
-        'R12': '1L02', 'R13': '1L03', 'R14': '1L04', 'R15': '1L05', 'R16': '1L06', 'R17': '1L07', 'R18': '1L08',
-        'R19': '1L09', 'R1A': '1L10', 'R1B': '1L11', 'R1C': '1L12', 'R1D': '1L13', 'R1E': '1L14', 'R1F': '1L15',
-        'R1G': '1L16', 'R1H': '1L17', 'R1I': '1L18', 'R1J': '1L19', 'R1K': '1L20', 'R1L': '1L21', 'R1M': '1L22',
-        'R1N': '1L23', 'R1O': '1L24', 'R1P': '1L25', 'R1Q': '1L26',
-        'R22': '2L02', 'R23': '2L03', 'R24': '2L04', 'R25': '2L05', 'R26': '2L06', 'R27': '2L07', 'R28': '2L08',
-        'R29': '2L09', 'R2A': '2L10', 'R2B': '2L11', 'R2C': '2L12', 'R2D': '2L13', 'R2E': '2L14', 'R2F': '2L15',
-        'R2G': '2L16', 'R2H': '2L17', 'R2I': '2L18', 'R2J': '2L19', 'R2K': '2L20', 'R2L': '2L21', 'R2M': '2L22',
-        'R2N': '2L23', 'R2O': '2L24', 'R2P': '2L25', 'R2Q': '2L26'
-
-    }
-    return names[zone]
-
-
-def ced_zone_to_rf_zone(zone):
-    names = {
-        '1L02': 'R12', '1L03': 'R13', '1L04': 'R14', '1L05': 'R15', '1L06': 'R16', '1L07': 'R17', '1L08': 'R18',
-        '1L09': 'R19', '1L10': 'R1A', '1L11': 'R1B', '1L12': 'R1C', '1L13': 'R1D', '1L14': 'R1E', '1L15': 'R1F',
-        '1L16': 'R1G', '1L17': 'R1H', '1L18': 'R1I', '1L19': 'R1J', '1L20': 'R1K', '1L21': 'R1L', '1L22': 'R1M',
-        '1L23': 'R1N', '1L24': 'R1O', '1L25': 'R1P', '1L26': 'R1Q',
-        '2L02': 'R22', '2L03': 'R23', '2L04': 'R24', '2L05': 'R25', '2L06': 'R26', '2L07': 'R27', '2L08': 'R28',
-        '2L09': 'R29', '2L10': 'R2A', '2L11': 'R2B', '2L12': 'R2C', '2L13': 'R2D', '2L14': 'R2E', '2L15': 'R2F',
-        '2L16': 'R2G', '2L17': 'R2H', '2L18': 'R2I', '2L19': 'R2J', '2L20': 'R2K', '2L21': 'R2L', '2L22': 'R2M',
-        '2L23': 'R2N', '2L24': 'R2O', '2L25': 'R2P', '2L26': 'R2Q'
-
-    }
-    return names[zone]
-
-
-def gset_cb(pvname, value, **kwargs):
-    if pvname not in fe_onset.keys():
-        return
-
-    # Register the change
-    global gc_lock
-    global gset_changed
-    with gc_lock:
-        gset_changed = True
-        gmes_changed[f"{pvname[0:(len(prefix) + 4)]}GMES"] = value
-
-    # Only log if this is a state change for the cavity
-    if value > fe_onset[pvname]:
-        if pvname not in fe_active.keys() or not fe_active[pvname]:
-            logging.debug(f"{pvname} is ACTIVE (GSET: {value}, Onset: {fe_onset[pvname]})")
-        fe_active[pvname] = True
-    else:
-        if pvname not in fe_active.keys() or fe_active[pvname]:
-            logging.debug(f"{pvname} is DEACTIVE (GSET: {value}, Onset: {fe_onset[pvname]})")
-        fe_active[pvname] = False
+# Shared random number generator.  Draw arrays of samples from this instead of one value per call.
+rng = np.random.default_rng()
+
+# Lowest random starting gradient by cavity type.  Cavities of other types do not get gradient PVs.
+_GRADIENT_LOW = {'C100': 5, 'C75': 5, 'C50': 3, 'C25': 3, 'P1R': 5}
+
+# One session for every CED query so connections are pooled and kept alive between requests
+ced_session = requests.Session()
+ced_session.mount('http://', SSLContextAdapter())
+ced_session.mount('https://', SSLContextAdapter())
+
+# PV suffixes set up for every cavity, and the full set by cavity type.  Every cavity gets ODVH, RFONr and ACK1.  The
+# known types add GSET, GMES and two tuner PVs.  C100s/C75s/P1Rs report tuner state with CFQE/DETAHZHI.  C25s/C50s
+# use TDETA/TDETA_N.  setup_cavities writes the starting values in this order.
+_BASE_PV_SUFFIXES = ('ODVH', 'RFONr', 'ACK1')
+_CAVITY_PV_SUFFIXES = {
+    'C100': _BASE_PV_SUFFIXES + ('GSET', 'GMES', 'CFQE', 'DETAHZHI'),
+    'C75': _BASE_PV_SUFFIXES + ('GSET', 'GMES', 'CFQE', 'DETAHZHI'),
+    'C50': _BASE_PV_SUFFIXES + ('GSET', 'GMES', 'TDETA', 'TDETA_N'),
+    'C25': _BASE_PV_SUFFIXES + ('GSET', 'GMES', 'TDETA', 'TDETA_N'),
+    'P1R': _BASE_PV_SUFFIXES + ('GSET', 'GMES', 'CFQE', 'DETAHZHI'),
+}
+
+# Lookup tables between RF (EPICS) zone names and CED zone names
+_RF_TO_CED = {
+    'R12': '1L02', 'R13': '1L03', 'R14': '1L04', 'R15': '1L05', 'R16': '1L06', 'R17': '1L07', 'R18': '1L08',
+    'R19': '1L09', 'R1A': '1L10', 'R1B': '1L11', 'R1C': '1L12', 'R1D': '1L13', 'R1E': '1L14', 'R1F': '1L15',
+    'R1G': '1L16', 'R1H': '1L17', 'R1I': '1L18', 'R1J': '1L19', 'R1K': '1L20', 'R1L': '1L21', 'R1M': '1L22',
+    'R1N': '1L23', 'R1O': '1L24', 'R1P': '1L25', 'R1Q': '1L26',
+    'R22': '2L02', 'R23': '2L03', 'R24': '2L04', 'R25': '2L05', 'R26': '2L06', 'R27': '2L07', 'R28': '2L08',
+    'R29': '2L09', 'R2A': '2L10', 'R2B': '2L11', 'R2C': '2L12', 'R2D': '2L13', 'R2E': '2L14', 'R2F': '2L15',
+    'R2G': '2L16', 'R2H': '2L17', 'R2I': '2L18', 'R2J': '2L19', 'R2K': '2L20', 'R2L': '2L21', 'R2M': '2L22',
+    'R2N': '2L23', 'R2O': '2L24', 'R2P': '2L25', 'R2Q': '2L26'
+}
+
+# The inverse is derived so the two tables can never disagree
+_CED_TO_RF = {ced: rf for rf, ced in _RF_TO_CED.items()}
+
+# Bind the dict lookups directly so there is no per-call function overhead.  Raises KeyError on unknown zones.
+rf_zone_to_ced_zone = _RF_TO_CED.__getitem__
+ced_zone_to_rf_zone = _CED_TO_RF.__getitem__
+
+
+def gset_cb(pvname, value, cid, _onsets=fe_onset, _active=fe_active, _gmes=gmes_names, _changed=gmes_changed,
+            _lock=fe_active_lock, **kwargs):
+    """GSET callback.  cid is the cavity ID given to add_callback, which pyepics passes back through.
+
+    The underscore arguments bind the module-level containers as locals since this runs on every GSET update.  They
+    are only ever mutated in place, never reassigned, so the bound objects stay current.  Don't pass them.
+    """
+    global num_fe_active
+    onset = _onsets[cid]
+
+    # Keep a running count of active cavities so update_ndx doesn't have to walk fe_active.
+    active = value > onset
+    with _lock:
+        was_active = _active[cid]
+        _active[cid] = active
+        if active and not was_active:
+            num_fe_active += 1
+        elif not active and was_active:
+            num_fe_active -= 1
+
+    # Register the change.  This wakes the main loop, so only do it once the field emission state above is current.
+    _changed.put((_gmes[cid], value))
+
+    # Only log if this is a state change for the cavity.  This runs on every GSET update, so let logging do the
+    # formatting only if the message will actually be emitted.
+
+    if active and was_active is not True:
+        logging.debug("%s is ACTIVE (GSET: %s, Onset: %s)", pvname, value, onset)
+    elif not active and was_active is not False:
+        logging.debug("%s is DEACTIVE (GSET: %s, Onset: %s)", pvname, value, onset)
 
 
 def save_pid():
@@ -97,8 +129,10 @@ def setup_ndx() -> None:
               '1S02', '2L22', '2L23', '2L24', '2L25', '2L26', '2L27', '2S01', '2S02']:
         pv_name = f"{prefix}INX{i}_nCur"
         PVs[pv_name] = PV(pv_name)
+        cur_pvs.append(PVs[pv_name])
         pv_name = f"{prefix}INX{i}_gCur"
         PVs[pv_name] = PV(pv_name)
+        cur_pvs.append(PVs[pv_name])
     for i in ['1L05', '1L07', '1L11', '1L15', '1L16', '1L21', '1L23', '1L25', '1L27', '2L21', '2L23', '2L25', '2L27']:
         pv_name = f"{prefix}NDX{i}_CAPACITOR_SW"
         PVs[pv_name] = PV(pv_name)
@@ -106,12 +140,6 @@ def setup_ndx() -> None:
         PVs[pv_name] = PV(pv_name)
 
 
-def append_pairs(names: List[str], values: List[float], name: str, value: float):
-    """Append a name and value to arrays in the same order."""
-    names.append(name)
-    values.append(value)
-
-
 def setup_cavities() -> None:
     """Creates cavities from CED data and adds to linac and zone.  Expects _setup_zones to have been run."""
     ced_params = 't=CryoCavity&p=EPICSName&p=CavityType&p=MaxGSET&p=OpsGsetMax&p=Bypassed&p=Length&p=Housed_by' \
@@ -121,16 +149,37 @@ def setup_cavities() -> None:
 
     pv_list = []
     val_list = []
+    gset_pv_names = []  # The GSET PVs that need gset_cb.  Tracked as they are added so we don't search for them later.
+    gset_cids = {}  # GSET PV name to cavity ID
+
+    # Draw the starting gradients with one vectorized call per cavity type instead of one call per cavity
+    max_gsets = np.zeros(len(cavity_elements))
+    idx_by_type = {}
+    bypassed_idxs = []
+    for idx, elem in enumerate(cavity_elements):
+        if elem['name'].startswith("0L"):
+            continue
+        props = elem['properties']
+        max_gsets[idx] = float(props['OpsGsetMax'] if 'OpsGsetMax' in props.keys() else props['MaxGSET'])
+        idx_by_type.setdefault(props['CavityType'], []).append(idx)
+        if 'Bypassed' in props.keys():
+            bypassed_idxs.append(idx)
+
+    gradients = np.zeros(len(cavity_elements))
+    for cavity_type, idxs in idx_by_type.items():
+        if cavity_type in _GRADIENT_LOW:
+            gradients[idxs] = rng.uniform(_GRADIENT_LOW[cavity_type], max_gsets[idxs])
+    gradients[bypassed_idxs] = 0
+
+    # Draw the GMES noise for every cavity at once
+    gmes_values = gradients + rng.uniform(0, max_gradient_noise, size=len(cavity_elements))
 
-    for elem in cavity_elements:
+    for idx, elem in enumerate(cavity_elements):
 
         # We only want to focus on the NL
         if elem['name'].startswith("0L"):
             continue
 
-        bypassed = False
-        if 'Bypassed' in elem['properties'].keys():
-            bypassed = True
         epics_name = elem['properties']['EPICSName']
         max_gset = elem['properties']['MaxGSET']
         cavity_type = elem['properties']['CavityType']
@@ -139,71 +188,21 @@ def setup_cavities() -> None:
         max_gset = float(max_gset)
         cavity_lengths[epics_name] = float(elem['properties']['Length'])
 
-        # Set the ODVH records to the CED values
-        append_pairs(pv_list, val_list, f"{prefix}{epics_name}ODVH", max_gset)
-
-        # Set the cavities to RF On state.  C100s/C75s are RFONr.  C25s/C50s are a weird bitword thing.
-        append_pairs(pv_list, val_list, f"{prefix}{epics_name}RFONr", 1)
-
-        # MBBI. ACK1.B6 is zone RF on, so assign 64 (=2^6) to set B6 to 1 (B# is zero-indexed)
-        append_pairs(pv_list, val_list, f"{prefix}{epics_name}ACK1", 64)
-
         # FE onset here is simply one less than max gradient
-        fe_onset[f"{prefix}{epics_name}GSET"] = max(float(max_gset) - 1, 7)
-
-        if cavity_type == "C100":
-            # Gradient PVs
-            gradient = 0 if bypassed else np.random.uniform(5, max_gset)
-            append_pairs(pv_list, val_list, f"{prefix}{epics_name}GSET", gradient)
-            gmes = gradient + np.random.uniform(0, max_gradient_noise, 1)[0]
-            append_pairs(pv_list, val_list, f"{prefix}{epics_name}GMES", gmes)
-
-            # Tuner info
-            append_pairs(pv_list, val_list, f"{prefix}{epics_name}CFQE", 0)
-            append_pairs(pv_list, val_list, f"{prefix}{epics_name}DETAHZHI", 10)
-        elif cavity_type == "C75":
-            # Gradient PVs
-            gradient = 0 if bypassed else np.random.uniform(5, max_gset)
-            append_pairs(pv_list, val_list, f"{prefix}{epics_name}GSET", gradient)
-            gmes = gradient + np.random.uniform(0, max_gradient_noise, 1)[0]
-            append_pairs(pv_list, val_list, f"{prefix}{epics_name}GMES", gmes)
-
-            # Tuner info
-            append_pairs(pv_list, val_list, f"{prefix}{epics_name}CFQE", 0)
-            append_pairs(pv_list, val_list, f"{prefix}{epics_name}DETAHZHI", 10)
-        elif cavity_type == "C50":
-            # Gradient PVs
-            gradient = 0 if bypassed else np.random.uniform(3, max_gset)
-            append_pairs(pv_list, val_list, f"{prefix}{epics_name}GSET", gradient)
-            gmes = gradient + np.random.uniform(0, max_gradient_noise, 1)[0]
-            append_pairs(pv_list, val_list, f"{prefix}{epics_name}GMES", gmes)
-            # val_list.append(0 if bypassed else np.random.uniform(3, max_gset))
-
-            # Tuner info
-            append_pairs(pv_list, val_list, f"{prefix}{epics_name}TDETA", 0)
-            append_pairs(pv_list, val_list, f"{prefix}{epics_name}TDETA_N", 10)
-        elif cavity_type == "C25":
-            # Gradient PVs
-            gradient = 0 if bypassed else np.random.uniform(3, max_gset)
-            append_pairs(pv_list, val_list, f"{prefix}{epics_name}GSET", gradient)
-            gmes = gradient + np.random.uniform(0, max_gradient_noise, 1)[0]
-            append_pairs(pv_list, val_list, f"{prefix}{epics_name}GMES", gmes)
-            # val_list.append(0 if bypassed else np.random.uniform(3, max_gset))
-
-            # Tuner info
-            append_pairs(pv_list, val_list, f"{prefix}{epics_name}TDETA", 0)
-            append_pairs(pv_list, val_list, f"{prefix}{epics_name}TDETA_N", 10)
-        elif cavity_type == "P1R":
-            # Gradient PVs
-            gradient = 0 if bypassed else np.random.uniform(5, max_gset)
-            append_pairs(pv_list, val_list, f"{prefix}{epics_name}GSET", gradient)
-            gmes = gradient + np.random.uniform(0, max_gradient_noise, 1)[0]
-            append_pairs(pv_list, val_list, f"{prefix}{epics_name}GMES", gmes)
-            # val_list.append(0 if bypassed else np.random.uniform(5, max_gset))
-
-            # Tuner info
-            append_pairs(pv_list, val_list, f"{prefix}{epics_name}CFQE", 0)
-            append_pairs(pv_list, val_list, f"{prefix}{epics_name}DETAHZHI", 10)
+        gset_cids[f"{prefix}{epics_name}GSET"] = len(fe_onset)
+        fe_onset.append(max(float(max_gset) - 1, 7))
+        gmes_names.append(f"{prefix}{epics_name}GMES")
+        fe_active.append(None)
+
+        # Values go in the order of the suffix templates.  ODVH is set to the CED value.  The cavities start in the RF
+        # On state.  ACK1 is an MBBI where B6 is zone RF on, so assign 64 (=2^6) to set B6 to 1 (B# is zero-indexed).
+        if cavity_type in _CAVITY_PV_SUFFIXES:
+            pv_list.extend(f"{prefix}{epics_name}{suffix}" for suffix in _CAVITY_PV_SUFFIXES[cavity_type])
+            val_list.extend((max_gset, 1, 64, gradients[idx], gmes_values[idx], 0, 10))
+            gset_pv_names.append(f"{prefix}{epics_name}GSET")
+        else:
+            pv_list.extend(f"{prefix}{epics_name}{suffix}" for suffix in _BASE_PV_SUFFIXES)
+            val_list.extend((max_gset, 1, 64))
 
     # Setup a callback that will make radiation signal appear above FE onset
     logging.debug("Creating Cavity PVs")
@@ -217,30 +216,40 @@ def setup_cavities() -> None:
     # pv_list.append(pv_name)
     # val_list.append(gradient + np.random.uniform(0, max_gradient_noise, 1)[0])
 
+    # The EMES calculation runs every time a gradient changes.  Work out which PVs and lengths it uses once here.
+    for linac in '12':
+        epicsnames = [name for name in sorted(cavity_lengths.keys()) if name[1] == linac]
+        emes_gmes_names.extend(f"{prefix}{epicsname}GMES" for epicsname in epicsnames)
+        emes_lengths[linac] = np.array([cavity_lengths[epicsname] for epicsname in epicsnames], dtype=np.float64)
+        pv_name = f"{prefix}R{linac}XXEMES"
+        PVs[pv_name] = PV(pv_name)
+        if not PVs[pv_name].wait_for_connection(timeout=1):
+            logging.error(f"{pv_name}: Timed out while waiting on connection.")
+
     logging.debug("Initializing Cavity PVs")
     time.sleep(0.05)
-    for pv_name in pv_list:
-        if pv_name.endswith("GSET"):
-            PVs[pv_name].add_callback(gset_cb)
+    for pv_name in gset_pv_names:
+        PVs[pv_name].add_callback(gset_cb, cid=gset_cids[pv_name])
     caput_many(pv_list, val_list, wait=True)
     time.sleep(0.05)
     logging.debug("Finished Initializing Cavity PVs")
 
 
+@functools.lru_cache(maxsize=8)
 def get_ced_elements(ced_url: str) -> List[Dict]:
-    """Queries the CED with the supplied URL.  URL MUST include out=json argument."""
+    """Queries the CED with the supplied URL.  URL MUST include out=json argument.
 
-    with requests.Session() as s:
-        adapter = SSLContextAdapter()
-        s.mount(ced_url, adapter)
-        r = s.get(ced_url)
+    The CED does not change while the IOC runs, so results are cached by URL.  Don't modify the returned list.
+    """
+    r = ced_session.get(ced_url, timeout=30)
 
     if r.status_code != 200:
         raise ValueError(
             "Received error response from {}.  status_code={}.  response={}".format(ced_url, r.status_code, r.text))
 
-    # The built-in JSON decoder will raise a ValueError if parsing non-JSON content
-    out = r.json()
+    # Parse the raw bytes directly.  json handles UTF-8 bytes itself, so this skips building a decoded copy of the
+    # body in r.text.  The built-in JSON decoder will raise a ValueError if parsing non-JSON content.
+    out = json.loads(r.content)
     if out['stat'] != 'ok':
         raise ValueError("Received non-ok status response")
 
@@ -248,73 +257,93 @@ def get_ced_elements(ced_url: str) -> List[Dict]:
 
 
 def update_ndx(force_change):
-    global gset_changed
-    global gc_lock
-    with gc_lock:
-        if gset_changed or force_change:
-            gset_changed = False
-            num_active = 0
-            noise = np.random.uniform(0, 0.01)
-
-            # Sometimes the unit tests want to mess directly with the gCur/nCur values.  Only update if the GSET was
-            # recently changed.  Make sure to mark the "recently changed" flag to false after we process it.
-            for cav in fe_active.keys():
-                if fe_active[cav]:
-                    num_active += 1
-
-            for pv in PVs.values():
-                if pv.connected:
-                    if pv.pvname.endswith("Cur"):
-                        pv.value = num_active + noise
-
-
-def update_gmes():
-    global gmes_changed
-    global gc_lock
-    with gc_lock:
-        for gmes_pv_name in gmes_changed.keys():
-            PVs[gmes_pv_name].value = gmes_changed[gmes_pv_name] + np.random.uniform(0, max_gradient_noise, 1)[0]
-        gmes_changed = {}
+    # Sometimes the unit tests want to mess directly with the gCur/nCur values.  Only update if the GSET was recently
+    # changed (the caller tells us) or we are forced to.
+    if force_change:
+        num_active = num_fe_active
+        noise = rng.uniform(0, 0.01)
+
+        # Send all of the updates as one batch instead of a round trip per PV
+        cur_pv_names = [pv.pvname for pv in cur_pvs if pv.connected]
+        caput_many(cur_pv_names, [num_active + noise] * len(cur_pv_names), wait=True)
+
+
+def update_gmes(timeout: float = 0.0) -> bool:
+    """Drain the queue of gradient changes and update the GMES PVs.  Returns True if any GMES was updated.
+
+    Args:
+        timeout: How long to block waiting for the first gradient change.  Don't block if <= 0.
+    """
+    # Only the most recent gradient matters if a cavity changed more than once since the last update
+    latest = {}
+    block = timeout > 0
+    while True:
+        try:
+            gmes_pv_name, value = gmes_changed.get(block=block, timeout=timeout if block else None)
+        except queue.Empty:
+            break
+        latest[gmes_pv_name] = value
+        # Only wait on the first change.  Take whatever else has already queued up.
+        block = False
+
+    if len(latest) == 0:
+        return False
+
+    gmes_pv_names = list(latest.keys())
+    noise = rng.uniform(0, max_gradient_noise, size=len(gmes_pv_names))
+    values = [latest[name] + noise[idx] for idx, name in enumerate(gmes_pv_names)]
+    caput_many(gmes_pv_names, values, wait=False)
+    return True
 
 
 class JTValve:
 
     def __init__(self, zone: str):
         self.zone = zone
-        self.recovery_datetime = None
+        self.recovery_deadline = None  # time.monotonic() value after which the valve recovers
         # This should be the ORBV field and not VAL in production.  But I can't figure out how to write to that
         # directly during testing.  I think the ORBV field is read only and requires device driver support.
         self.stroke_pv = PV(f"{prefix}CEV{zone}JT")
         self.alarm = False
         PVs[self.stroke_pv.pvname] = self.stroke_pv
-        if not self.stroke_pv.wait_for_connection(timeout=1):
+
+    def wait_for_connection(self, timeout: float = 1) -> bool:
+        """Wait on the stroke PV to connect.  Logs and returns False on timeout."""
+        if not self.stroke_pv.wait_for_connection(timeout=timeout):
             logging.error(f"{self.stroke_pv.pvname}: Timed out while waiting on connection.")
+            return False
+        return True
 
     def set_jt_high(self):
-        self.recovery_datetime = datetime.now() + timedelta(seconds=5)
+        self.recovery_deadline = time.monotonic() + 5.0
         self.stroke_pv.put(95.1, wait=False)
         self.alarm = True
+        heapq.heappush(jt_recovery_heap, (self.recovery_deadline, self.zone, self))
         logging.warning(f"{self.zone} JT valve went high.")
 
-    def check_jt_recovery(self):
-        if self.alarm:
-            if datetime.now() > self.recovery_datetime:
-                self.alarm = False
-                self.stroke_pv.put(np.random.uniform(40, 90))
-                logging.warning(f"{self.zone} JT valve back in spec.")
+    def recover(self):
+        """Bring the valve back in spec."""
+        self.alarm = False
+        self.stroke_pv.put(rng.uniform(40, 90))
+        logging.warning(f"{self.zone} JT valve back in spec.")
+
+
+def recover_jt_valves(now: float):
+    """Recover every JT valve whose recovery deadline has passed.  now is a time.monotonic() value."""
+    while jt_recovery_heap and jt_recovery_heap[0][0] < now:
+        _, _, jt = heapq.heappop(jt_recovery_heap)
+        jt.recover()
+
 
 def update_emes():
+    # Read both linacs in one caget_many so all of the CA gets are in flight together, then split the results
+    values = np.asarray(epics.caget_many(emes_gmes_names), dtype=np.float64)
+    start = 0
     for linac in '12':
-        epicsnames = [name for name in sorted(cavity_lengths.keys()) if name[1] == linac]
-        pvs = [f"{prefix}{epicsname}GMES" for epicsname in epicsnames]
-        values = epics.caget_many(pvs)
-        lengths = []
-        for epicsname in epicsnames:
-            lengths.append(cavity_lengths[epicsname])
-        lengths = np.array(lengths)
-        emes = np.sum(values * lengths)
-        emes_pv = PV(f"{prefix}R{linac}XXEMES")
-        emes_pv.put(emes)
+        lengths = emes_lengths[linac]
+        emes = float(np.dot(values[start:start + len(lengths)], lengths))
+        start += len(lengths)
+        PVs[f"{prefix}R{linac}XXEMES"].put(emes)
 
 
 
@@ -327,6 +356,11 @@ def setup_jt_valves():
                      '20', '21', '22', '23', '24', '25', '26']:
             z = f"{linac}{zone}"
             JT_valves[z] = JTValve(zone=z)
+
+    # Every CA search was already sent when the PVs were created above, so these waits overlap instead of each one
+    # paying for its own round trip.
+    for jt in JT_valves.values():
+        jt.wait_for_connection(timeout=1)
     logging.debug("Done setting Up JT Valves")
 
 
@@ -335,31 +369,46 @@ if __name__ == "__main__":
     setup_ndx()
     setup_cavities()
     setup_jt_valves()
-    count = 0
+    all_jt_valves = list(JT_valves.values())
     p_jt_high = 0
     # p_jt_high = 1e-5
 
+    # The JT valves are checked on a fixed tick.  Make this slow enough so my unit tests have a chance to make some
+    # changes without being overwritten.  0.01 was just a little too fast.  Radiation gets a forced refresh about
+    # once a second.
+    tick = 0.05
+    ndx_refresh = 1.0
+    next_tick = time.monotonic() + tick
+    next_ndx_refresh = time.monotonic() + ndx_refresh
+
     logging.debug("Entering main run loop.")
     while True:
-        # Make this slow enough so my unit tests have a chance to make some changes without
-        # being overwritten.  0.01 was just a little too fast
-        time.sleep(0.05)
-
-        if len(gmes_changed.keys()) > 0:
-            update_gmes()
+        # Sleep until a GSET changes or the next tick is due, whichever comes first
+        gset_changed = update_gmes(timeout=next_tick - time.monotonic())
+        if gset_changed:
             update_emes()
 
-        if count % 20 == 0:
-            update_ndx(force_change=True)
-        else:
-            update_ndx(force_change=False)
-        count += 1
-
-        for jt in JT_valves.values():
-            if jt.alarm:
-                jt.check_jt_recovery()
-            # 25 valves * 20 chances per second * 5 second duration * prob_trip_every_step,
-            # implies that 1/10000 prob there will be 0.025 JT valves too high on average.  The math is not the exact
-            # right formula, but good enough for testing without cracking open a book.
-            elif np.random.uniform(0, 1) > (1 - p_jt_high):
+        # Radiation only needs updating when a GSET changed, but refresh it periodically regardless
+        now = time.monotonic()
+        force_ndx = now >= next_ndx_refresh
+        if force_ndx:
+            next_ndx_refresh = now + ndx_refresh
+        update_ndx(force_change=gset_changed or force_ndx)
+
+        # Woken up early by a GSET change.  The JT valves aren't due yet.
+        if now < next_tick:
+            continue
+        next_tick = now + tick
+
+        # 25 valves * 20 chances per second * 5 second duration * prob_trip_every_step,
+        # implies that 1/10000 prob there will be 0.025 JT valves too high on average.  The math is not the exact
+        # right formula, but good enough for testing without cracking open a book.  Draw for every valve at once and
+        # only visit the ones that tripped.
+        trips = rng.random(size=len(all_jt_valves)) > (1 - p_jt_high)
+        for idx in np.flatnonzero(trips):
+            jt = all_jt_valves[idx]
+            if not jt.alarm:
                 jt.set_jt_high()
+
+        # Only the valves that are due come off the recovery heap
+        recover_jt_valves(now)
@@ -2,7 +2,7 @@
 
 import logging
 import argparse
-from time import sleep
+from time import sleep, monotonic
 from typing import Optional
 
 from epics import PV
@@ -157,11 +157,17 @@ def walk_pv(pv: PV, value: float, time: float = 5.0, n_steps: int = 10):
     """Walk a PV to a target value using n_steps over a period of time."""
     start = pv.value
     step = (value - start) / n_steps
+    interval = time / (n_steps - 1) if n_steps > 1 else 0
 
+    # Schedule each put against a fixed deadline so put latency doesn't add up over the walk
+    deadline = monotonic()
     for i in range(1, n_steps + 1):
-        pv.put(start + (i * step))
+        pv.put(start + (i * step), wait=False)
         if i < n_steps:
-            sleep(time / (n_steps - 1))
+            deadline += interval
+            remaining = deadline - monotonic()
+            if remaining > 0:
+                sleep(remaining)
 
     # Just in case there were some rounding errors, put the PV to the desired setting
     pv.put(value)
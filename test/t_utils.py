@@ -1,24 +1,166 @@
-from fe_daq.linac import Linac, Zone
+import concurrent.futures
+import copy
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Callable, Any, Dict, List
+
+import epics
+
+from fe_daq.linac import Linac, Zone, LinacFactory, wait_for_pvs
 from fe_daq.cavity import LLRF2Cavity, LLRF3Cavity
 from fe_daq import app_config as config
 
 
 PREFIX = "adamc:"
+TEST_CONFIG_FILE = config.app_root + "/test/dummy_fe_daq.json"
+CED_CACHE_DIR = config.app_root + "/test/ced_cache"
+_test_config = None  # The configuration dictionary last loaded by load_test_config
+
+# Reused by schedule_pv_put so tests don't start a new thread for every delayed put
+_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+
+# (controls_type, style_2) to (linac, zone, cavity, snapshot of the cavity's attributes after setup)
+_CACHE = {}
+
+# CED URL to the elements it returned, so each query is only read once per run
+_CED_ELEMENTS = {}
+
+
+class LazyMessage:
+    """An assertion message that is only built if it is needed.
+
+    unittest only converts an assertion's msg to a string when the assertion fails, so wrapping an expensive message
+    builder in this skips the work for passing assertions.
+    """
+
+    def __init__(self, func: Callable[[], str]):
+        self.func = func
+
+    def __str__(self) -> str:
+        return self.func()
+
+
+class CachedCEDLinacFactory(LinacFactory):
+    """A LinacFactory that caches its CED queries in memory and as JSON files in CED_CACHE_DIR.
+
+    The CED rarely changes, so this saves repeating the same slow queries across tests and test runs.  Set
+    FE_DAQ_REFRESH_CED=1 or delete CED_CACHE_DIR to pick up CED changes.
+    """
+
+    @staticmethod
+    def _get_ced_elements(ced_url: str) -> List[Dict]:
+        """Like LinacFactory._get_ced_elements, but cached.  Returns a copy so callers may modify the elements."""
+        if ced_url not in _CED_ELEMENTS:
+            cache_file = os.path.join(CED_CACHE_DIR, f"{hashlib.sha1(ced_url.encode()).hexdigest()}.json")
+            if os.path.exists(cache_file) and os.environ.get("FE_DAQ_REFRESH_CED", "0") != "1":
+                with open(cache_file, mode="r") as f:
+                    elements = json.load(f)
+            else:
+                elements = LinacFactory._get_ced_elements(ced_url)
+                os.makedirs(CED_CACHE_DIR, exist_ok=True)
+                with open(cache_file, mode="w") as f:
+                    json.dump(elements, f)
+            _CED_ELEMENTS[ced_url] = elements
+
+        return copy.deepcopy(_CED_ELEMENTS[ced_url])
+
+
+def load_test_config():
+    """Parse the test configuration file unless it is already the loaded configuration.
+
+    Every test module needs the same configuration, so only the first module to run (or the first after some test
+    clears or replaces the configuration) pays for reading the file.
+    """
+    global _test_config
+    if _test_config is None or config.get_parameter(None) is not _test_config:
+        config.parse_config_file(TEST_CONFIG_FILE)
+        _test_config = config.get_parameter(None)
+
+
+def schedule_pv_put(pv: epics.PV, value: Any, delay: float) -> concurrent.futures.Future:
+    """Put value to pv after delay seconds from a shared worker thread.  Call result() on the return to wait for it."""
+    deadline = time.monotonic() + delay
+
+    def _put():
+        time.sleep(max(0.0, deadline - time.monotonic()))
+        pv.put(value)
+
+    return _EXECUTOR.submit(_put)
 
 
-def get_linac_zone_cavity(controls_type='2.0', style_2='old'):
+def wait_for_pv_value(pv: epics.PV, predicate: Callable[[Any], bool], timeout: float = 1.0) -> bool:
+    """Wait until a PV monitor delivers a value that satisfies predicate.  Returns False on timeout.
+
+    This is driven by a temporary callback, so it returns as soon as the update arrives instead of sleeping a fixed
+    amount of time.
+    """
+    event = threading.Event()
+
+    def cb(value, **kwargs):
+        if predicate(value):
+            event.set()
+
+    index = pv.add_callback(cb)
+    try:
+        # The update may have already arrived before the callback was added
+        if predicate(pv.value):
+            return True
+        return event.wait(timeout)
+    finally:
+        pv.remove_callback(index)
+
+
+def wait_for_all_connections(*objs, timeout: float = 2.0):
+    """Wait for the PVs of every object to connect against one shared deadline.  Raise if any fail to connect.
+
+    The PVs started searching when they were created, so waiting on them together means the total wait is bounded by
+    the slowest PV instead of the sum of each object's wait.  Each object's own wait_for_connections is still called
+    afterwards so any post-connection setup runs.
+    """
+    wait_for_pvs([pv for obj in objs for pv in obj.pv_list], timeout)
+
+    # Everything is connected, so these only do their post-connection work
+    for obj in objs:
+        obj.wait_for_connections()
+
+
+def clear_pv_callbacks(*objs):
+    """Remove the value and connection callbacks from every PV of the given objects.
+
+    This lets a test retire objects so their callbacks stop reporting to StateMonitor, while the underlying CA
+    channels stay cached and connected for the next objects that use the same PVs.
+    """
+    for obj in objs:
+        for pv in obj.pv_list:
+            pv.clear_callbacks()
+            pv.connection_callbacks = []
+
+
+def get_linac_zone_cavity(controls_type='2.0', style_2='old', update_gset_max: bool = True, connect: bool = True):
+    """Build a connected linac, zone and cavity for testing.  Skip cavity.update_gset_max if update_gset_max is False.
+
+    If connect is False, don't wait for any PVs to connect (which also skips update_gset_max).  This is for tests that
+    only touch a few PVs and can wait for those themselves.
+    """
     config.validate_config()
-    lp_min = config.get_parameter('linac_pressure_min')
-    lp_max = config.get_parameter('linac_pressure_max')
-    lp_recovery_margin = config.get_parameter('linac_pressure_margin')
-    heater_capacity_min = config.get_parameter('cryo_heater_margin_min')
-    heater_recover_margin = config.get_parameter('cryo_heater_margin_recovery_margin')
-    jt_max = config.get_parameter('jt_valve_position_max')
-    jt_recovery_margin = config.get_parameter('jt_valve_margin')
+    params = config.get_parameters(['linac_pressure_min', 'linac_pressure_max', 'linac_pressure_margin',
+                                    'cryo_heater_margin_min', 'cryo_heater_margin_recovery_margin',
+                                    'jt_valve_position_max', 'jt_valve_margin', 'LLRF2_tuner_recovery_margin',
+                                    'LLRF3_tuner_recovery_margin'])
+    lp_min = params['linac_pressure_min']
+    lp_max = params['linac_pressure_max']
+    lp_recovery_margin = params['linac_pressure_margin']
+    heater_capacity_min = params['cryo_heater_margin_min']
+    heater_recover_margin = params['cryo_heater_margin_recovery_margin']
+    jt_max = params['jt_valve_position_max']
+    jt_recovery_margin = params['jt_valve_margin']
 
     # TODO: Add LLRF 1.0
     if controls_type == '2.0':
-        tuner_recovery_margin = config.get_parameter('LLRF2_tuner_recovery_margin')
+        tuner_recovery_margin = params['LLRF2_tuner_recovery_margin']
         linac = Linac("NorthLinac", prefix=PREFIX, linac_pressure_min=lp_min, linac_pressure_max=lp_max,
                       linac_pressure_recovery_margin=lp_recovery_margin, heater_margin_min=heater_capacity_min,
                       heater_recovery_margin=heater_recover_margin)
@@ -29,7 +171,7 @@ def get_linac_zone_cavity(controls_type='2.0', style_2='old'):
         if style_2 == 'old':
             cav.fcc_firmware_version = 2018.0
     elif controls_type == '3.0':
-        tuner_recovery_margin = config.get_parameter('LLRF3_tuner_recovery_margin')
+        tuner_recovery_margin = params['LLRF3_tuner_recovery_margin']
         linac = Linac("NorthLinac", prefix=PREFIX, linac_pressure_min=lp_min,  linac_pressure_max=lp_max,
                       linac_pressure_recovery_margin=lp_recovery_margin, heater_margin_min=heater_capacity_min,
                       heater_recovery_margin=heater_recover_margin)
@@ -40,10 +182,34 @@ def get_linac_zone_cavity(controls_type='2.0', style_2='old'):
     else:
         raise RuntimeError("Unsupported controls_type")
 
-    linac.wait_for_connections()
-    zone.wait_for_connections()
-    cav.wait_for_connections()
+    if not connect:
+        return linac, zone, cav
+
+    wait_for_all_connections(linac, zone, cav)
+
+    if update_gset_max:
+        cav.update_gset_max()
+
+    return linac, zone, cav
+
+
+def get_cached_linac_zone_cavity(controls_type='2.0', style_2='old'):
+    """Like get_linac_zone_cavity, but builds and connects each configuration only once.
 
-    cav.update_gset_max()
+    Later calls reset the cavity's attributes (gset_max, bypassed_eff, tuner_bad, etc.) to their post-setup values
+    instead of paying for the CA connections again.  Tests are still responsible for restoring any PV values they
+    change.  Call clear_cache if EPICS CA has been reset.
+    """
+    key = (controls_type, style_2)
+    if key not in _CACHE:
+        linac, zone, cav = get_linac_zone_cavity(controls_type=controls_type, style_2=style_2)
+        _CACHE[key] = (linac, zone, cav, dict(vars(cav)))
 
+    linac, zone, cav, snapshot = _CACHE[key]
+    vars(cav).update(snapshot)
     return linac, zone, cav
+
+
+def clear_cache():
+    """Forget any linac/zone/cavity built by get_cached_linac_zone_cavity."""
+    _CACHE.clear()
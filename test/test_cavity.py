@@ -1,21 +1,19 @@
-import threading
+import queue
 import time
 from datetime import datetime
-from threading import Thread
 from unittest import TestCase
 import logging
 
-import epics
+import numpy as np
 
-from fe_daq import app_config as config
 from fe_daq.cavity import Cavity
-from test.t_utils import get_linac_zone_cavity
+from test.t_utils import get_cached_linac_zone_cavity, wait_for_pv_value, load_test_config, schedule_pv_put
 
 # logging.basicConfig(level=logging.DEBUG)
 
 
 def setUpModule():
-    config.parse_config_file(config.app_root + "/test/dummy_fe_daq.json")
+    load_test_config()
 
 
 logger = logging.getLogger()
@@ -29,15 +27,9 @@ def get_gradient_step_size(cavity: Cavity):
     return step
 
 
-def stop_ramping(pvname, delay=0.5):
-    pv = epics.PV(pvname)
-    time.sleep(delay)
-    pv.put(0)
-
-
 class TestCavity(TestCase):
     def test_get_jiggled_pset_value(self):
-        linac, zone, cav = get_linac_zone_cavity()
+        linac, zone, cav = get_cached_linac_zone_cavity()
 
         init = cav.pset_init
 
@@ -46,16 +38,15 @@ class TestCavity(TestCase):
         self.assertEqual(init, result)
 
         # Check that we don't get any values back outside of range +/- delta
-        max_val = 0
         delta = 100
-        for i in range(100):
-            tmp = cav.get_jiggled_pset_value(delta=delta) - init
-            if abs(tmp) > max_val:
-                max_val = tmp
+        max_val = np.abs(cav.get_jiggled_pset_value(delta=delta, size=100) - init).max()
         self.assertTrue(delta > max_val, f"Jiggled too much.  Observed max jiggle {max_val} (>{delta})")
 
+        # A single value comes back as a plain number
+        self.assertTrue(np.isscalar(cav.get_jiggled_pset_value(delta=delta)))
+
     def test_calculate_heat(self):
-        linac, zone, cav = get_linac_zone_cavity()
+        linac, zone, cav = get_cached_linac_zone_cavity()
 
         # Test that the answer is expected when we supply the gradient
         exp = 10 * 10 * 1e12 * 0.7 / (1241.3 * 6e9)
@@ -69,21 +60,17 @@ class TestCavity(TestCase):
         self.assertAlmostEqual(exp, result, 2)
 
     def test_walk_gradient(self):
-
+        # Keep the CA callback as short as possible.  SimpleQueue.put is thread-safe, so no lock is needed.
+        values = queue.SimpleQueue()
+        def track_values_cb(value, **kwargs):
+            values.put(value)
+
+        # The cavity is shared with other tests, so put back the GSET and remove our callback when done
+        linac, zone, cav = get_cached_linac_zone_cavity()
+        pre_walk_gset = cav.gset.value
+        cb_index = None
         try:
-            values_lock = threading.Lock()
-            values = {}
-            def track_values_cb(pvname, value, **kwargs):
-                with values_lock:
-                    if pvname not in values.keys():
-                        values[pvname] = [value]
-                    else:
-                        values[pvname].append(value)
-
-            linac, zone, cav = get_linac_zone_cavity()
-
             # Can't walk higher than ODVH, and it shouldn't even try
-            pre_walk_gset = cav.gset.value
             with self.assertRaises(Exception) as context:
                 cav.walk_gradient(100)
             post_walk_gset = cav.gset.value
@@ -93,26 +80,30 @@ class TestCavity(TestCase):
 
             # Set the sleep interval very small so we don't have to wait long for this test.
             cav.gmes_sleep_interval = 0.01
-            cav.gset.put(cav.gset_min + 3, wait=True)
-            time.sleep(0.01)
             start = cav.gset_min + 3
+            cav.gset.put(start, wait=True)
+            # The walk starts from the monitored GSET value, so make sure the update has been delivered
+            self.assertTrue(wait_for_pv_value(cav.gset, lambda v: v == start))
             exp = [start - 1, start - 2, start - 2.5]
-            cav.gset.add_callback(track_values_cb)
+            cb_index = cav.gset.add_callback(track_values_cb)
             cav.walk_gradient(gset=cav.gset.value-2.5, settle_time=0.01, wait_for_ramp=False, step_size=1,
                               wait_interval=0.1)
 
-            with values_lock:
-                result = values[cav.gset.pvname].copy()
+            result = []
+            while not values.empty():
+                result.append(values.get_nowait())
 
             # Since we enforce software-based gradient ramping, we need to just check that the specific values were included
             # The exact  ramping values used will swamp the few step sizes we expect.
             for value in exp:
                 self.assertIn(value, result)
         finally:
-            cav.gset.put(pre_walk_gset)
+            if cb_index is not None:
+                cav.gset.remove_callback(cb_index)
+            cav.gset.put(pre_walk_gset, wait=True)
 
     def test_set_gradient_bad_tuner(self):
-        linac, zone, cav = get_linac_zone_cavity()
+        linac, zone, cav = get_cached_linac_zone_cavity()
         cav.tuner_bad = False
         val = cav.gset.value
         cav.set_gradient(val + 0.01, settle_time=0, wait_for_ramp=False)
@@ -124,7 +115,7 @@ class TestCavity(TestCase):
 
 
     def test_set_gradient(self):
-        linac, zone, cav = get_linac_zone_cavity()
+        linac, zone, cav = get_cached_linac_zone_cavity()
         with self.assertRaises(Exception) as context:
             cav.set_gradient(0.1, settle_time=0, wait_for_ramp=False)
 
@@ -154,35 +145,31 @@ class TestCavity(TestCase):
         cav.gset_max = old_max
 
     def test_is_cavity_tuning(self):
-        linac, zone, cav = get_linac_zone_cavity(controls_type='3.0')
+        linac, zone, cav = get_cached_linac_zone_cavity(controls_type='3.0')
         cfqe_old = cav.cfqe.value
         try:
             # Tuning threshold is set to 10 for test cases
-            cav.cfqe.put(40)
-            time.sleep(0.1)
+            cav.cfqe.put(40, wait=True)
+            self.assertTrue(wait_for_pv_value(cav.cfqe, lambda v: v == 40))
             self.assertTrue(cav.is_tuning_required())
-            time.sleep(0.1)
-            cav.cfqe.put(0)
-            time.sleep(0.1)
+            cav.cfqe.put(0, wait=True)
+            self.assertTrue(wait_for_pv_value(cav.cfqe, lambda v: v == 0))
             self.assertFalse(cav.is_tuning_required())
         finally:
             cav.cfqe.put(cfqe_old)
 
     def test_set_gradient_tuning(self):
-        linac, zone, cav = get_linac_zone_cavity(controls_type='3.0')
+        linac, zone, cav = get_cached_linac_zone_cavity(controls_type='3.0')
         cfqe_old = cav.cfqe.value
         gset_old = cav.gset.value
 
-        def do_tune():
-            cav.cfqe.put(0)
-
         tuning_time = 1
         try:
             cav.cfqe.put(20, wait=True)
-            time.sleep(0.05)
+            self.assertTrue(wait_for_pv_value(cav.cfqe, lambda v: v == 20))
 
             start = datetime.now()
-            threading.Timer(tuning_time, do_tune).start()
+            schedule_pv_put(cav.cfqe, 0, delay=tuning_time)
             if cav.gset.value > cav.gset_min:
                 cav.set_gradient(max(cav.gset_min, cav.gset.value-0.01), settle_time=0)
             else:
@@ -199,7 +186,7 @@ class TestCavity(TestCase):
 
     def test_set_gradient_ramping(self):
         # This tests if we are watching the ramping properly for old LLRF2.0 cavities.
-        linac, zone, cav = get_linac_zone_cavity()
+        linac, zone, cav = get_cached_linac_zone_cavity()
 
         ramp_time = 0.25
         gset = cav.gset.value
@@ -207,18 +194,17 @@ class TestCavity(TestCase):
         if cav.odvh.value < gset + 0.1:
             step = -0.1
 
-        # Test that we do wait for ramping to be done
-        cav.stat1.put(2048)
-        t1 = Thread(target=stop_ramping, args=(cav.stat1.pvname, ramp_time))
-        start = datetime.now()
-
         # Manually set it so we don't have any extra waits and the whole thing happens in one step.
         cav.gmes_sleep_interval = 0
         cav.gmes_step_size = 0.1
-        t1.start()
+
+        # Test that we do wait for ramping to be done
+        cav.stat1.put(2048)
+        start = datetime.now()
+        stop_ramping = schedule_pv_put(cav.stat1, 0, delay=ramp_time)
         cav.set_gradient(gset + step, settle_time=0)
         end = datetime.now()
-        t1.join()
+        stop_ramping.result()
         waited = (end - start).total_seconds()
         delta = abs(ramp_time - waited)
         # There is a polling cycle when checking to see if a cavity is done ramping.  Should be around 10 Hz.
@@ -226,7 +212,7 @@ class TestCavity(TestCase):
 
     def test_set_gradient_ramping_interactive(self):
         # This test requires user input since the ramp_time will exceed 10s
-        linac, zone, cav = get_linac_zone_cavity()
+        linac, zone, cav = get_cached_linac_zone_cavity()
 
         ramp_time = 0.5
         gset = cav.gset.value
@@ -235,17 +221,17 @@ class TestCavity(TestCase):
         # Test that we do wait for ramping to be done
         print("Please enter 'y' at the prompt.")
         cav.stat1.put(2048)
-        t1 = Thread(target=stop_ramping, args=(cav.stat1.pvname, ramp_time))
-        t1.start()
+        stop_ramping = schedule_pv_put(cav.stat1, 0, delay=ramp_time)
         cav.set_gradient(gset + step, settle_time=0, ramp_timeout=0.3)
-        t1.join()
+        stop_ramping.result()
 
     def test_restore_pset(self):
-        linac, zone, cav = get_linac_zone_cavity()
+        linac, zone, cav = get_cached_linac_zone_cavity()
         exp = cav.pset_init
 
         cav.pset.put(exp + 1, wait=True)
         cav.restore_pset()
 
-        time.sleep(0.01)
+        # restore_pset waits on the put, but the monitored value can still lag slightly behind
+        self.assertTrue(wait_for_pv_value(cav.pset, lambda v: v == exp))
         self.assertEqual(exp, cav.pset.value)
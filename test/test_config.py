@@ -28,6 +28,18 @@ class TestCavity(TestCase):
         finally:
             config.clear_config()
 
+    def test_parse_config_file_cached_copy(self):
+        # Test that reparsing an unchanged file is not affected by changes made to the previously parsed config
+        try:
+            config.parse_config_file(test_dir + "/config-test.json")
+            config.set_parameter(['test-dict', 'test'], 456)
+            config.get_parameter('test-array').append(4)
+            config.parse_config_file(test_dir + "/config-test.json")
+            self.assertEqual(config.get_parameter(['test-dict', 'test']), 123)
+            self.assertListEqual(config.get_parameter('test-array'), [1, 2, 3])
+        finally:
+            config.clear_config()
+
     def test_config_multiple_threads(self):
         # Test that a change in one thread is seen back in another
         def _setter():
@@ -59,3 +71,9 @@ class TestCavity(TestCase):
         config.set_parameter(['testing', '13'], 'test-value')
         self.assertEqual(config.get_parameter(['testing', '13']), 'test-value')
 
+    def test_config_get_parameters(self):
+        config.clear_config()
+        config.set_parameter('testing', {'13': 'test-value'})
+        config.set_parameter('testing2', 'test-value2')
+        exp = {'testing2': 'test-value2', ('testing', '13'): 'test-value', 'missing': None}
+        self.assertDictEqual(config.get_parameters(['testing2', ['testing', '13'], 'missing']), exp)
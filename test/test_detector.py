@@ -1,9 +1,12 @@
 from unittest import TestCase
 import logging
+import threading
 import numpy as np
+import epics
+from scipy.stats import ttest_ind
 
-from fe_daq import app_config as config
-from fe_daq.detector import NDXElectrometer, NDXDetector
+from fe_daq.detector import NDXElectrometer, NDXDetector, welch_t_stat
+from test.t_utils import load_test_config, wait_for_pv_value
 
 
 # logging.basicConfig(level=logging.DEBUG)
@@ -11,16 +14,12 @@ logger = logging.getLogger()
 
 
 def setUpModule():
-    config.parse_config_file(config.app_root + "/test/dummy_fe_daq.json")
+    load_test_config()
 
 
-ndxe_toggled_off = {}
-
-
-def turned_off_cb(pvname, value, **kwargs):
-    if value == 0:
-        logging.warning(f"{pvname} turned off")
-        ndxe_toggled_off[pvname] = True
+def put_currents(ndxd: NDXDetector, gamma: float, neutron: float) -> None:
+    """Set both detector currents with a single batched CA put."""
+    epics.caput_many([ndxd.gamma_current.pvname, ndxd.neutron_current.pvname], [gamma, neutron], wait=True)
 
 
 class TestNDXElectrometer(TestCase):
@@ -32,60 +31,90 @@ class TestNDXElectrometer(TestCase):
             self.fail(msg=f"Could not connect to {e.daq_enabled.pvname}")
 
         # Check that we end in the on state no matter what
+        # The puts are synchronous, so the monitor will catch up to them.  Wait on it rather than forcing a CA get.
         e.daq_enabled.put(0, wait=True)
         e.toggle_data_acquisition()
-        self.assertEqual(1, e.daq_enabled.get(use_monitor=False))
+        self.assertTrue(wait_for_pv_value(e.daq_enabled, lambda v: v == 1))
 
         e.daq_enabled.value = 1
         e.toggle_data_acquisition()
-        self.assertEqual(1, e.daq_enabled.get(use_monitor=False))
+        self.assertTrue(wait_for_pv_value(e.daq_enabled, lambda v: v == 1))
 
-        # Check that the DAQ is actually disabled
-        e.daq_enabled.add_callback(turned_off_cb)
-        e.toggle_data_acquisition()
-        self.assertTrue(ndxe_toggled_off[e.daq_enabled.pvname])
+        # Check that the DAQ is actually disabled.  Track this per test with a local event and remove the callback
+        # afterwards so that nothing leaks into other tests that use this PV.
+        toggled_off = threading.Event()
+
+        def turned_off_cb(pvname, value, **kwargs):
+            if value == 0:
+                logger.warning(f"{pvname} turned off")
+                toggled_off.set()
+
+        index = e.daq_enabled.add_callback(turned_off_cb)
+        try:
+            e.toggle_data_acquisition()
+            self.assertTrue(toggled_off.wait(timeout=1))
+        finally:
+            e.daq_enabled.remove_callback(index)
 
     def test_set_for_fe_onset(self):
         e = NDXElectrometer(name="NDX1L24", epics_name="adamc:NDX1L24", I400=2)
 
-        e.capacitor_switch.put(1000, wait=True)
-        e.integration_period.put(2, wait=True)
+        epics.caput_many([e.capacitor_switch.pvname, e.integration_period.pvname], [1000, 2], wait=True)
 
         e.set_for_fe_onset()
         self.assertEqual("10pF", e.capacitor_switch.get(use_monitor=False, as_string=True))
-        self.assertEqual(1, e.integration_period.get(use_monitor=False))
-        self.assertEqual(1, e.daq_enabled.get(use_monitor=False))
+        self.assertTrue(wait_for_pv_value(e.integration_period, lambda v: v == 1))
+        self.assertTrue(wait_for_pv_value(e.daq_enabled, lambda v: v == 1))
 
     def test_set_for_operations(self):
         e = NDXElectrometer(name="NDX1L24", epics_name="adamc:NDX1L24", I400=2)
 
-        e.capacitor_switch.put(10, wait=True)
-        e.integration_period.put(2, wait=True)
+        epics.caput_many([e.capacitor_switch.pvname, e.integration_period.pvname], [10, 2], wait=True)
 
         e.set_for_operations()
         self.assertEqual("1000pF", e.capacitor_switch.get(use_monitor=False, as_string=True))
-        self.assertEqual(1, e.integration_period.get(use_monitor=False))
-        self.assertEqual(1, e.daq_enabled.get(use_monitor=False))
+        self.assertTrue(wait_for_pv_value(e.integration_period, lambda v: v == 1))
+        self.assertTrue(wait_for_pv_value(e.daq_enabled, lambda v: v == 1))
+
+
+class TestWelchTStat(TestCase):
+
+    def test_welch_t_stat(self):
+        b = np.array([0.00001, 0.00001, 0.00002])
+        self.assertAlmostEqual(11.935155278687867, welch_t_stat(np.array([0.0011, 0.0012, 0.0009]), b), 10)
+
+        # Unequal sample sizes should still match scipy's Welch's t-test
+        a = np.array([1.0, 1.5, 0.7, 1.2, 0.9])
+        exp = ttest_ind(a, b, equal_var=False).statistic
+        self.assertAlmostEqual(exp, welch_t_stat(a, b), 10)
 
 
 class TestNDXDetector(TestCase):
 
+    @classmethod
+    def setUpClass(cls):
+        # Share one detector (and its PV connections) across tests.  setUp resets its recorded data.
+        cls.ndxd = NDXDetector(name="INX1L23", epics_name="adamc:INX1L23", electrometer=None)
+        cls.ndxd.wait_for_connections()
+
+    def setUp(self):
+        self.ndxd.clear_measurements()
+        self.ndxd.gamma_background = None
+        self.ndxd.neutron_background = None
+
     def test_take_measurement(self):
-        ndxd = NDXDetector(name="INX1L23", epics_name="adamc:INX1L23", electrometer=None)
-        # ndxd.clear_measurements()
+        ndxd = self.ndxd
 
         # Check that we start at zero
         self.assertEqual(0, np.sum(ndxd.gamma_measurements))
         self.assertEqual(0, np.sum(ndxd.neutron_measurements))
 
-        ndxd.gamma_current.put(0.5, wait=True)
-        ndxd.neutron_current.put(0.5, wait=True)
+        put_currents(ndxd, 0.5, 0.5)
 
         # Normally we'd wait between samples, but here we just take samples.
         ndxd.take_measurement()
         ndxd.take_measurement()
-        ndxd.gamma_current.put(1, wait=True)
-        ndxd.neutron_current.put(1, wait=True)
+        put_currents(ndxd, 1, 1)
         ndxd.take_measurement()
 
         # 2 x 0.5 + 1 = 2
@@ -93,102 +122,74 @@ class TestNDXDetector(TestCase):
         self.assertEqual(2, np.sum(ndxd.neutron_measurements), f"{ndxd.neutron_measurements}")
 
     def test_update_background(self):
-        ndxd = NDXDetector(name="INX1L23", epics_name="adamc:INX1L23", electrometer=None)
+        ndxd = self.ndxd
 
         # Samples should be 0.5, 0.5, 1.0
-        ndxd.gamma_current.put(0.5, wait=True)
-        ndxd.neutron_current.put(0.5, wait=True)
+        put_currents(ndxd, 0.5, 0.5)
         ndxd.take_measurement()
         ndxd.take_measurement()
-        ndxd.gamma_current.put(1, wait=True)
-        ndxd.neutron_current.put(1, wait=True)
+        put_currents(ndxd, 1, 1)
         ndxd.take_measurement()
 
         ndxd.update_background()
 
-        self.assertListEqual(ndxd.gamma_background, ndxd.gamma_measurements)
-        self.assertListEqual(ndxd.neutron_background, ndxd.neutron_measurements)
-
-    def test_is_radiation_above_background(self):
-        ndxd = NDXDetector(name="INX1L23", epics_name="adamc:INX1L23", electrometer=None)
+        np.testing.assert_array_equal(ndxd.gamma_background, ndxd.gamma_measurements)
+        np.testing.assert_array_equal(ndxd.neutron_background, ndxd.neutron_measurements)
 
-        # Samples should be 0.5, 0.5, 1.0
-        ndxd.gamma_current.put(0.00001, wait=True)
-        ndxd.neutron_current.put(0.00001, wait=True)
-        ndxd.take_measurement()
-        ndxd.take_measurement()
-        ndxd.gamma_current.put(0.00002, wait=True)
-        ndxd.neutron_current.put(0.00002, wait=True)
+        # The background is a copy, so it should not change when new measurements come in
+        ndxd.clear_measurements()
         ndxd.take_measurement()
+        np.testing.assert_array_equal(ndxd.gamma_background, [0.5, 0.5, 1.0])
+        np.testing.assert_array_equal(ndxd.neutron_background, [0.5, 0.5, 1.0])
 
-        ndxd.update_background()
-
-        # Background and measurements should be equal
-        is_rad, t_stat = ndxd.is_radiation_above_background()
-        self.assertFalse(is_rad, "Error: Background was lower than itself!")
-        self.assertEqual(0, t_stat, "Error: comparing background to itself.  Should always be t_stat == zero")
+    def test_take_measurement_wraps(self):
+        ndxd = NDXDetector(name="INX1L23", epics_name="adamc:INX1L23", electrometer=None, max_samples=2)
 
-        # Now step up the gamma radiation and measure it.
-        ndxd.clear_measurements()
-        ndxd.gamma_current.put(0.0011, wait=True)
-        ndxd.neutron_current.put(0.00001, wait=True)
-        ndxd.take_measurement()
-        ndxd.gamma_current.put(0.0012, wait=True)
-        ndxd.take_measurement()
-        ndxd.gamma_current.put(0.0009, wait=True)
-        ndxd.neutron_current.put(0.00002, wait=True)
-        ndxd.take_measurement()
+        # Only the most recent max_samples are kept
+        for value in [0.5, 1.0, 2.0]:
+            put_currents(ndxd, value, value)
+            ndxd.take_measurement()
 
-        nb = ascii(ndxd.neutron_background)
-        nm = ascii(ndxd.neutron_measurements)
-        gb = ascii(ndxd.gamma_background)
-        gm = ascii(ndxd.gamma_measurements)
-
-        # gamma ttest_ind here should be 11.93515, and t_threshold by default is 5
-        is_rad, t_stat = ndxd.is_radiation_above_background()
-        self.assertTrue(is_rad, f"Error: expected radiation to be above background.\n"
-                                f"nb = {nb}, nm = {nm}\n"
-                                f"gb = {gb}, gm = {gm}")
-        is_rad, t_stat = ndxd.is_radiation_above_background(t_stat_threshold=12)
-        self.assertFalse(is_rad, f"Error: threshold doesn't match.\n"
-                                 f"nb = {nb}, nm = {nm}\n"
-                                 f"gb = {gb}, gm = {gm}")
-        self.assertAlmostEqual(11.935155278687867, t_stat, 10)
-
-        # Turn gamma down, but up neutron
-        ndxd.clear_measurements()
-        ndxd.gamma_current.put(0.00001, wait=True)
-        ndxd.neutron_current.put(0.0011, wait=True)
-        ndxd.take_measurement()
-        ndxd.neutron_current.put(0.0012, wait=True)
-        ndxd.take_measurement()
-        ndxd.gamma_current.put(0.00002, wait=True)
-        ndxd.neutron_current.put(0.0009, wait=True)
-        ndxd.take_measurement()
+        self.assertEqual(2, len(ndxd.gamma_measurements))
+        self.assertEqual(3, np.sum(ndxd.gamma_measurements))
+        self.assertEqual(3, np.sum(ndxd.neutron_measurements))
 
-        # neutron ttest_ind here should be 11.93515, and t_threshold by default is 5
-        is_rad, t_stat = ndxd.is_radiation_above_background()
-        self.assertTrue(is_rad, f"Error: expected radiation to be above background {t_stat} {ndxd.neutron_measurements}"
-                                f" {ndxd.neutron_background}")
-        self.assertAlmostEqual(11.935155278687867, t_stat, 10)
-        is_rad, t_stat = ndxd.is_radiation_above_background(t_stat_threshold=12)
-        self.assertFalse(is_rad, "Error: threshold doesn't match")
+    def take_samples(self, samples) -> None:
+        """Clear the shared detector's measurements, then record one measurement per (gamma, neutron) sample."""
+        self.ndxd.clear_measurements()
+        for gamma, neutron in samples:
+            put_currents(self.ndxd, gamma, neutron)
+            self.ndxd.take_measurement()
 
-        # Now make the current negative so it has to be less than background.  We don't want to alert on this.
-        # Turn gamma down, but up neutron
-        ndxd.clear_measurements()
-        ndxd.gamma_current.put(-1, wait=True)
-        ndxd.neutron_current.put(-1, wait=True)
-        ndxd.take_measurement()
-        ndxd.gamma_current.put(-1.1, wait=True)
-        ndxd.neutron_current.put(-1.1, wait=True)
-        ndxd.take_measurement()
-        ndxd.gamma_current.put(-1.02, wait=True)
-        ndxd.neutron_current.put(-1.02, wait=True)
-        ndxd.take_measurement()
+    def test_is_radiation_above_background(self):
+        ndxd = self.ndxd
 
-        # Both t-stats should be negative and not alert even with a low threshold
-        is_rad, t_stat = ndxd.is_radiation_above_background(t_stat_threshold=0)
-        self.assertFalse(is_rad, f"Error: threshold doesn't match. t-stat={t_stat}")
-        self.assertAlmostEqual(-34.04242710996176, t_stat, 10, f"{ndxd.gamma_measurements} {ndxd.neutron_measurements}")
+        # Record the background.  Comparing it to itself should give t_stat == 0 and no radiation.
+        background = [(0.00001, 0.00001), (0.00001, 0.00001), (0.00002, 0.00002)]
+        self.take_samples(background)
+        ndxd.update_background()
 
+        # Each scenario is (name, samples, expected t_stat, [(t_stat_threshold, expected is_rad), ...]).  They are run
+        # as subtests against the same background, so one failing scenario does not hide the others.
+        scenarios = [
+            ("background", background, 0, [(5, False)]),
+            # gamma ttest_ind here should be 11.93515, and t_threshold by default is 5
+            ("gamma", [(0.0011, 0.00001), (0.0012, 0.00001), (0.0009, 0.00002)], 11.935155278687867,
+             [(5, True), (12, False)]),
+            # neutron ttest_ind here should be 11.93515, and t_threshold by default is 5
+            ("neutron", [(0.00001, 0.0011), (0.00001, 0.0012), (0.00002, 0.0009)], 11.935155278687867,
+             [(5, True), (12, False)]),
+            # Current lower than background.  Both t-stats should be negative and not alert even with a low threshold
+            ("negative", [(-1, -1), (-1.1, -1.1), (-1.02, -1.02)], -34.04242710996176, [(0, False)]),
+        ]
+
+        for name, samples, exp_t_stat, checks in scenarios:
+            with self.subTest(scenario=name):
+                self.take_samples(samples)
+                for threshold, exp_is_rad in checks:
+                    is_rad, t_stat = ndxd.is_radiation_above_background(t_stat_threshold=threshold)
+                    if is_rad != exp_is_rad:
+                        self.fail(f"Error: expected is_rad={exp_is_rad} at threshold {threshold}, t_stat={t_stat}\n"
+                                  f"nb = {ascii(ndxd.neutron_background)}, nm = {ascii(ndxd.neutron_measurements)}\n"
+                                  f"gb = {ascii(ndxd.gamma_background)}, gm = {ascii(ndxd.gamma_measurements)}")
+                    self.assertAlmostEqual(exp_t_stat, t_stat, 10)
@@ -1,5 +1,3 @@
-import time
-from typing import List
 from unittest import TestCase
 import logging
 import numpy as np
@@ -7,112 +5,79 @@ import epics
 
 from fe_daq import app_config as config
 from fe_daq.cavity import Cavity
+from fe_daq.detector import NDXDetector
 from fe_daq.linac import LinacFactory, Linac, Zone
+from test.t_utils import load_test_config, CachedCEDLinacFactory
 
 # logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger()
 
+# The NorthLinac is expensive to build (CED queries and PV connections for every cavity), so build it once and share
+# it between test classes.  Tests should not leave persistent changes on it.
+_north_linac = None
+
+
+# Linac/Zone constructor arguments taken from the test config.  These are read once in setUpModule.
+_linac_kwargs = {}
+_zone_kwargs = {}
+
+
 def setUpModule():
-    config.parse_config_file(config.app_root + "/test/dummy_fe_daq.json")
+    load_test_config()
+    config.validate_config()
+
+    params = config.get_parameters(['linac_pressure_min', 'linac_pressure_max', 'linac_pressure_margin',
+                                    'cryo_heater_margin_min', 'cryo_heater_margin_recovery_margin',
+                                    'jt_valve_position_max', 'jt_valve_margin'])
+    _linac_kwargs.update(linac_pressure_min=params['linac_pressure_min'],
+                         linac_pressure_max=params['linac_pressure_max'],
+                         linac_pressure_recovery_margin=params['linac_pressure_margin'],
+                         heater_margin_min=params['cryo_heater_margin_min'],
+                         heater_recovery_margin=params['cryo_heater_margin_recovery_margin'])
+    _zone_kwargs.update(jt_max=params['jt_valve_position_max'], jt_recovery_margin=params['jt_valve_margin'])
+
+
+def get_north_linac() -> Linac:
+    """Return the shared NorthLinac, creating it the first time this is called."""
+    global _north_linac
+    if _north_linac is None:
+        _north_linac = CachedCEDLinacFactory(testing=True).create_linac("NorthLinac")
+    return _north_linac
 
 
 def get_linac_zone(linac_name, zone_name, controls_type):
-    config.validate_config()
-    lp_min = config.get_parameter('linac_pressure_min')
-    lp_max = config.get_parameter('linac_pressure_max')
-    lp_recovery_margin = config.get_parameter('linac_pressure_margin')
-    heater_capacity_min = config.get_parameter('cryo_heater_margin_min')
-    heater_recover_margin = config.get_parameter('cryo_heater_margin_recovery_margin')
-    jt_max = config.get_parameter('jt_valve_position_max')
-    jt_recovery_margin = config.get_parameter('jt_valve_margin')
-
-    linac = Linac(linac_name, prefix="adamc:", linac_pressure_min=lp_min, linac_pressure_max=lp_max,
-                  linac_pressure_recovery_margin=lp_recovery_margin, heater_margin_min=heater_capacity_min,
-                  heater_recovery_margin=heater_recover_margin)
-    zone = Zone(name=zone_name, linac=linac, controls_type=controls_type, jt_max=jt_max,
-                jt_recovery_margin=jt_recovery_margin)
+    linac = Linac(linac_name, prefix="adamc:", **_linac_kwargs)
+    zone = Zone(name=zone_name, linac=linac, controls_type=controls_type, **_zone_kwargs)
     linac.zones[zone_name] = zone
     return linac, zone
 
 
-# This is a routine that should not be used with a real linac since it could overwhelm cryo and cause it to trip.
-def set_gradients(linac: Linac, exclude_cavs: List[Cavity] = None, exclude_zones: List['Zone'] = None,
-                  level: str = "low") -> None:
-    """Set the cavity gradients high/low for cavities in the zone, optionally excluding some cavities
-
-    Arguments:
-        linac: The linac on which to make changes
-        exclude_cavs: A list of cavities that should not be changed.  None if all cavities should be changed
-        exclude_zones: A list of zones that should not be changed.  None if all zones should be changed
-        level:  'low' for their defined low level, 'high' for close to ODVH
-
-    """
-
-    # We'll use the put_many call since we're dealing with multiple PVs
-    pvlist = []
-    values = []
-    for cav in linac.cavities.values():
-
-        # Check if we are excluding this cavity or zone from change
-        if exclude_cavs is not None:
-            skip = False
-            for ex_cav in exclude_cavs:
-                if cav.name == ex_cav.name:
-                    skip = True
-            if skip:
-                logger.debug(f"Skipping cavity {cav.name} explicitly")
-                continue
-        if exclude_zones is not None:
-            skip = False
-            for ex_zone in exclude_zones:
-                if cav.zone.name == ex_zone.name:
-                    logger.debug(f"Skipping cavity {cav.name} in excluded {ex_zone.name}")
-                    skip = True
-            if skip:
-                continue
-
-        if cav.bypassed:
-            continue
-
-        if not cav.gset.pvname.startswith("adamc:"):
-            raise RuntimeError("Do not under any circumstances try this with real PVs!.")
-
-        pvlist.append(cav.gset.pvname)
-        if level == "high":
-            # For varying over the linac we want a broader range since this includes cavities with trip models
-            val = np.random.uniform(cav.odvh.value - 3, cav.odvh.value)
-        elif level == "low":
-            val = cav.get_low_gset()
-        else:
-            msg = "Unsupported level specified"
-            logger.error(msg)
-            raise ValueError(msg)
-        values.append(val)
-        logger.debug(f"Cav: {cav.name},  ODVH: {cav.odvh.get()}, GSET: {val}")
-
-    epics.caput_many(pvlist, values, wait=True)
-
-
 class TestLinacFactory(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # The factory holds no per-linac state, so one instance can serve every test.  Tests that need a fresh linac
+        # build their own via get_linac_zone and the factory's _setup_* methods.
+        cls.lf = CachedCEDLinacFactory(testing=True)
+        cls.linac = get_north_linac()
+
     def test_create_linac(self):
-        lf = LinacFactory(testing=True)
-        linac = lf.create_linac("NorthLinac")
+        linac = self.linac
 
         # Check some of the cavities exist
         self.assertEqual(linac.zones['1L19'].cavities['1L19-1'].name, '1L19-1')
         self.assertEqual(linac.cavities['1L19-1'].name, '1L19-1')
-        self.assertTrue("2L10-1" not in linac.cavities.keys())
+        self.assertNotIn("2L10-1", linac.cavities)
 
         # Check some of the zones exist
         self.assertEqual(linac.zones['1L19'].name, '1L19')
         self.assertEqual(linac.zones['1L23'].name, '1L23')
-        self.assertTrue("2L10" not in linac.zones.keys())
+        self.assertNotIn("2L10", linac.zones)
 
     def test__setup_cavities(self):
         # Add some gset_max limits via config
         config.set_parameter('gset_max', {'R1M1': 6, 'R1M2': 500})
 
-        lf = LinacFactory(testing=True)
+        lf = self.lf
 
         # Check that the segmask filtering works
         linac, zone = get_linac_zone('NorthLinac', '1L11', '1.0')
@@ -121,11 +86,11 @@ class TestLinacFactory(TestCase):
         lf._setup_cavities(linac)
 
         config.clear_config()
-        config.parse_config_file(config.app_root + "/test/dummy_fe_daq.json")
+        load_test_config()
 
         self.assertEqual(linac.zones['1L19'].cavities['1L19-1'].name, '1L19-1')
         self.assertEqual(linac.cavities['1L19-1'].name, '1L19-1')
-        self.assertTrue("2L10-1" not in linac.cavities.keys())
+        self.assertNotIn("2L10-1", linac.cavities)
 
         # Test that the config is being read, applied, and sanity checked
         # R1M1 GSET.DRVH should be higher than 6, so this value should stick
@@ -135,7 +100,7 @@ class TestLinacFactory(TestCase):
         self.assertTrue(linac.cavities['1L22-2'].gset_max <= 25)
 
     def test__setup_zones(self):
-        lf = LinacFactory(testing=True)
+        lf = self.lf
 
         # Check that the segmask filtering works
         linac, zone = get_linac_zone('NorthLinac', '1L11', '1.0')
@@ -144,7 +109,7 @@ class TestLinacFactory(TestCase):
 
         self.assertEqual(linac.zones['1L19'].name, '1L19')
         self.assertEqual(linac.zones['1L23'].name, '1L23')
-        self.assertTrue("2L10" not in linac.zones.keys())
+        self.assertNotIn("2L10", linac.zones)
 
         # Check that the zone_names filtering works
         linac, zone = get_linac_zone('NorthLinac', '1L11', '1.0')
@@ -152,18 +117,21 @@ class TestLinacFactory(TestCase):
         lf._setup_zones(linac, zone_names=['1L19'])
 
         self.assertEqual(linac.zones['1L19'].name, '1L19')
-        self.assertTrue("1L23" not in linac.zones.keys())
-        self.assertTrue("2L10" not in linac.zones.keys())
+        self.assertNotIn("1L23", linac.zones)
+        self.assertNotIn("2L10", linac.zones)
 
     def test__get_ced_elements(self):
         url = "http://ced.acc.jlab.org/inventory?ced=ced&workspace=ops&t=CryoCavity&out=json"
 
-        lf = LinacFactory(testing=True)
-        elements = lf._get_ced_elements(url)
+        # Check the real query, not the test cache in front of it
+        elements = LinacFactory._get_ced_elements(url)
         self.assertEqual(418, len(elements))
 
 
 class TestLinac(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.linac = get_north_linac()
 
     def test_add_cavity(self):
         linac, zone = get_linac_zone('NorthLinac', '1L11', '1.0')
@@ -171,52 +139,44 @@ class TestLinac(TestCase):
                         Q0=6e9, tuner_timeout=10, tuner_bad=False)
 
         # Test that the cavity is missing
-        self.assertFalse(cavity.name in linac.cavities.keys())
-        self.assertFalse(cavity.name in linac.zones['1L11'].cavities.keys())
+        self.assertNotIn(cavity.name, linac.cavities)
+        self.assertNotIn(cavity.name, linac.zones['1L11'].cavities)
 
         # Add the cavity, check that it is present
         linac.add_cavity(cavity)
-        self.assertTrue(cavity.name in linac.cavities.keys())
-        self.assertTrue(cavity.name in linac.zones['1L11'].cavities.keys())
+        self.assertIn(cavity.name, linac.cavities)
+        self.assertIn(cavity.name, linac.zones['1L11'].cavities)
 
-    def test_get_radiation_measurements(self):
-        # Disable this unless needed later
-        return
-        lf = LinacFactory(testing=True)
-        linac = lf.create_linac("NorthLinac")
+    def test_batch_t_stats(self):
+        linac, zone = get_linac_zone('NorthLinac', '1L23', '1.0')
+        for name in ("INX1L23", "INX1L24"):
+            linac.ndx_detectors[name] = NDXDetector(name=name, epics_name=f"adamc:{name}", electrometer=None)
 
-        set_gradients(linac, level="low")
-        time.sleep(0.05)  # Sleep just long enough for my dumb IOC controller script to react to this.
-        num_samples = 3
-        linac.get_radiation_measurements(num_samples)
+        for gamma, neutron in [(0.00001, 0.00001), (0.00001, 0.00001), (0.00002, 0.00002)]:
+            epics.caput_many([f"adamc:{name}_{sig}" for name in linac.ndx_detectors for sig in ("gCur", "nCur")],
+                             [gamma, neutron] * len(linac.ndx_detectors), wait=True)
+            for ndxd in linac.ndx_detectors.values():
+                ndxd.take_measurement()
+        linac.save_radiation_measurements_as_background()
 
         for ndxd in linac.ndx_detectors.values():
-            ndxd.update_background()
+            ndxd.clear_measurements()
+        for gamma in [0.0011, 0.0012, 0.0009]:
+            epics.caput_many([f"adamc:{name}_gCur" for name in linac.ndx_detectors], [gamma, 0.00001], wait=True)
+            for ndxd in linac.ndx_detectors.values():
+                ndxd.take_measurement()
 
+        result = linac.batch_t_stats()
         for ndxd in linac.ndx_detectors.values():
-            self.assertEqual(num_samples, len(ndxd.gamma_measurements),
-                             f"{ndxd.name}: gamma measurement length wrong. {ndxd.gamma_measurements}")
-            self.assertEqual(num_samples, len(ndxd.neutron_measurements),
-                             f"{ndxd.name}: neutron measurement length wrong. {ndxd.neutron_measurements}")
-            is_rad, t_stat = ndxd.is_radiation_above_background()
-            self.assertFalse(is_rad,
-                             f"{ndxd.name}: Rad too high, g_t: {ndxd.get_gamma_t_stat()},"
-                             f" n_t: {ndxd.get_neutron_t_stat()}")
-
-        set_gradients(linac=linac, level="high")
-        time.sleep(0.05)  # Sleep just long enough for my dumb IOC controller script to react to this.
-        num_samples = 3
-        linac.get_radiation_measurements(num_samples)
+            self.assertAlmostEqual(ndxd.get_gamma_t_stat(pedantic=True), result[ndxd.name][0], 10)
+            self.assertAlmostEqual(ndxd.get_neutron_t_stat(pedantic=True), result[ndxd.name][1], 10)
+        self.assertAlmostEqual(11.935155278687867, result['INX1L23'][0], 10)
 
-        for ndxd in linac.ndx_detectors.values():
-            self.assertEqual(num_samples, len(ndxd.gamma_measurements),
-                             f"{ndxd.name}: gamma measurement length wrong. {ndxd.gamma_measurements}")
-            self.assertEqual(num_samples, len(ndxd.neutron_measurements),
-                             f"{ndxd.name}: neutron measurement length wrong. {ndxd.neutron_measurements}")
-            is_rad, t_stat = ndxd.is_radiation_above_background()
-            # print(t_stat)
-            self.assertTrue(is_rad,
-                            f"{ndxd.name}: Rad too low, g_t: {ndxd.get_gamma_t_stat()}, n_t: {ndxd.get_neutron_t_stat()}")
+        # is_radiation_above_background reports the largest of these t-stats
+        is_rad, max_t, max_d = linac.is_radiation_above_background(t_stat_threshold=5)
+        self.assertTrue(is_rad)
+        self.assertAlmostEqual(max(max(t) for t in result.values()), max_t, 10)
+        self.assertFalse(linac.is_radiation_above_background(t_stat_threshold=max_t + 1)[0])
 
     def test_scale_solution_up(self):
         x = np.ones(shape=(10,))
@@ -227,7 +187,7 @@ class TestLinac(TestCase):
 
         result = Linac._scale_solution_up(x=x, xu=xu, energy=energy, target_energy=target_energy, max_energy=max_energy)
         exp = np.array([1, 1.5, 1, 1.05, 1.5, 1, 2, 2.5, 1, 2.5])
-        self.assertListEqual(exp.tolist(), result.tolist())
+        np.testing.assert_allclose(result, exp)
 
     def test_scale_solution_down(self):
         x = np.ones(shape=(10,)) * 1
@@ -238,12 +198,11 @@ class TestLinac(TestCase):
 
         result = Linac._scale_solution_down(x=x, xl=xl, energy=energy, target_energy=target_energy, min_energy=min_energy)
         exp = np.array([1, 0.75, 1, 0.95, 0.75, 1, 0.6, 0.55, 1, 0.55])
-        self.assertListEqual(exp.tolist(), result.tolist())
+        np.testing.assert_allclose(result, exp)
 
     def test_scale_gradients_to_meet_energy(self):
         # Do a simple test.  If we plan to lower one cavity, verify that it gets turned up by the expected amount.
-        lf = LinacFactory(testing=True)
-        linac = lf.create_linac("NorthLinac")
+        linac = self.linac
         new_gsets = {'1L22-1': 5}
 
         orig_gsets = {cav.name: cav.gset.value for cav in linac.cavities.values() if not cav.bypassed_eff}
@@ -257,16 +216,22 @@ class TestLinac(TestCase):
         result = new_gsets['1L22-1']
 
         self.assertEqual(exp, result)
-        for cav in old_gsets.keys():
-            self.assertEqual(orig_gsets[cav], old_gsets[cav])
+        np.testing.assert_array_equal(
+            np.fromiter((orig_gsets[name] for name in old_gsets), dtype=np.float64, count=len(old_gsets)),
+            np.fromiter(old_gsets.values(), dtype=np.float64, count=len(old_gsets)))
+
+        cav_names = {cav.name for cav in cavs}
+        self.assertSetEqual(set(), cav_names - old_gsets.keys(), "Missing cavities from old_gsets")
+        self.assertSetEqual(set(), cav_names - new_gsets.keys(), "Missing cavities from new_gsets")
 
+        # Compare each zone's GSETs against new_gsets in one shot
+        zone_cavs = {}
         for cav in cavs:
-            if cav.name not in old_gsets:
-                self.fail(f"Missing {cav.name} from old_gsets")
-            if cav.name not in new_gsets:
-                self.fail(f"Missing {cav.name} from new_gsets")
-            if zones_gsets[cav.zone][cav.cavity_number -1] != new_gsets[cav.name]:
-                self.fail(f"Zone GSETs does not match new gset for {cav.name}")
+            zone_cavs.setdefault(cav.zone, []).append(cav)
+        for zone, z_cavs in zone_cavs.items():
+            np.testing.assert_array_equal([zones_gsets[zone][cav.cavity_number - 1] for cav in z_cavs],
+                                          [new_gsets[cav.name] for cav in z_cavs],
+                                          f"Zone GSETs does not match new gsets for {zone.name}")
 
 
 class TestZone(TestCase):
@@ -277,40 +242,19 @@ class TestZone(TestCase):
                                    zone=zone, Q0=6e9, tuner_bad=False)
 
         # Test that the cavity is missing
-        self.assertFalse(cavity.name in linac.cavities.keys())
-        self.assertFalse(cavity.name in linac.zones['1L11'].cavities.keys())
+        self.assertNotIn(cavity.name, linac.cavities)
+        self.assertNotIn(cavity.name, linac.zones['1L11'].cavities)
 
         # Add the cavity, check that it is present, but only in zone
         zone.add_cavity(cavity)
-        self.assertFalse(cavity.name in linac.cavities.keys())
-        self.assertTrue(cavity.name in linac.zones['1L11'].cavities.keys())
+        self.assertNotIn(cavity.name, linac.cavities)
+        self.assertIn(cavity.name, linac.zones['1L11'].cavities)
 
     def test_check_percent_heat_change(self):
         linac, zone = get_linac_zone('NorthLinac', '1L11', '1.0')
-        zone.add_cavity(
-            Cavity(name="1L11-1", epics_name="adamc:R1B1", cavity_type='C25', length=0.5, bypassed=True, zone=zone,
-                   Q0=6e9, tuner_timeout=10, tuner_bad=False))
-        zone.add_cavity(
-            Cavity(name="1L11-2", epics_name="adamc:R1B2", cavity_type='C25', length=0.5, bypassed=True, zone=zone,
-                   Q0=6e9, tuner_timeout=10, tuner_bad=False))
-        zone.add_cavity(
-            Cavity(name="1L11-3", epics_name="adamc:R1B3", cavity_type='C25', length=0.5, bypassed=True, zone=zone,
-                   Q0=6e9, tuner_timeout=10, tuner_bad=False))
-        zone.add_cavity(
-            Cavity(name="1L11-4", epics_name="adamc:R1B4", cavity_type='C25', length=0.5, bypassed=True, zone=zone,
-                   Q0=6e9, tuner_timeout=10, tuner_bad=False))
-        zone.add_cavity(
-            Cavity(name="1L11-5", epics_name="adamc:R1B5", cavity_type='C25', length=0.5, bypassed=True, zone=zone,
-                   Q0=6e9, tuner_timeout=10, tuner_bad=False))
-        zone.add_cavity(
-            Cavity(name="1L11-6", epics_name="adamc:R1B6", cavity_type='C25', length=0.5, bypassed=True, zone=zone,
-                   Q0=6e9, tuner_timeout=10, tuner_bad=False))
-        zone.add_cavity(
-            Cavity(name="1L11-7", epics_name="adamc:R1B7", cavity_type='C25', length=0.5, bypassed=True, zone=zone,
-                   Q0=6e9, tuner_timeout=10, tuner_bad=False))
-        zone.add_cavity(
-            Cavity(name="1L11-8", epics_name="adamc:R1B8", cavity_type='C25', length=0.5, bypassed=True, zone=zone,
-                   Q0=6e9, tuner_timeout=10, tuner_bad=False))
+        common = dict(cavity_type='C25', length=0.5, bypassed=True, zone=zone, Q0=6e9, tuner_timeout=10, tuner_bad=False)
+        for i in range(1, 9):
+            zone.add_cavity(Cavity(name=f"1L11-{i}", epics_name=f"adamc:R1B{i}", **common))
 
         # This should be a 100% heat loss
         zone.check_percent_heat_change(gradients=[0, 0, 0, 0, 0, 0, 0, 0], percentage=101)
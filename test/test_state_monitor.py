@@ -2,186 +2,230 @@ import logging
 
 from unittest import TestCase
 import concurrent.futures
+import threading
 import time
 
 import epics
 import numpy as np
 
-from fe_daq import app_config as config
 from fe_daq.cavity import Cavity
 from fe_daq.detector import NDXElectrometer
-from fe_daq.state_monitor import StateMonitor, get_threshold_cb
-from test.t_utils import get_linac_zone_cavity
+from fe_daq.state_monitor import StateMonitor, get_threshold_cb, get_hv_read_back_cb
+from test.t_utils import PREFIX, get_linac_zone_cavity, clear_cache, load_test_config, clear_pv_callbacks, \
+    LazyMessage
 
 logger = logging.getLogger()
-prefix = "adamc:"
-jt_suffix = ""
+
+
+# Objects created by the current test.  reinit_all retires them so their callbacks don't leak into the next test.
+_test_objects = []
+
+# Shared by the flapping workers so each call doesn't pay to create and seed a new generator
+_rng = np.random.default_rng()
 
 
 def setUpModule():
-    config.parse_config_file(config.app_root + "/test/dummy_fe_daq.json")
+    load_test_config()
+
+
+def track(*objs):
+    """Register objects created by a test so that reinit_all can clear their PV callbacks."""
+    _test_objects.extend(objs)
+    return objs
 
 
 def reinit_all():
     old_level = logger.level
     logger.setLevel(logging.CRITICAL)
-    # "Restart" EPICS CA.
-    epics.ca.clear_cache()
+
+    # Stop the previous test's PVs from reporting to the StateMonitor.  The CA channels themselves are kept so the
+    # next test can reuse the connections.
+    clear_pv_callbacks(*_test_objects)
+    _test_objects.clear()
 
     # Clear out the state of previous PVs
     StateMonitor.clear_state()
     logger.setLevel(old_level)
 
-    # Reinitialize the configuration
-    config.clear_config()
-    config.parse_config_file(config.app_root + "/test/dummy_fe_daq.json")
+    # Reload the configuration only if something replaced it
+    load_test_config()
+
+
+def wait_for_daq_good(good: bool = True, timeout: float = 1.0) -> bool:
+    """Wait until the StateMonitor's daq_good matches good.  Wakes up as soon as the callbacks report the change."""
+    return StateMonitor.wait_for(lambda: StateMonitor.daq_good() == good, timeout=timeout)
+
+
+def flap(bad, good, pvname, n=3, max_sleep=0.001):
+    """Report pvname with bad and then good n times, at random intervals of up to max_sleep seconds."""
+    # Sleep until precomputed offsets from the start so that oversleeping on one iteration doesn't add up over the run
+    offsets = _rng.uniform(0, max_sleep, size=n).cumsum().tolist()
+    start = time.monotonic()
+    for offset in offsets:
+        time.sleep(max(0.0, start + offset - time.monotonic()))
+        bad(pvname=pvname)
+        good(pvname=pvname)
 
 
 def flapping_pv(pvname, n=3, max_sleep=0.001):
-    for i in range(n):
-        time.sleep(np.random.uniform(0, max_sleep))
-        StateMonitor.pv_disconnected(pvname=pvname)
-        StateMonitor.pv_reconnected(pvname=pvname)
+    flap(StateMonitor.pv_disconnected, StateMonitor.pv_reconnected, pvname, n=n, max_sleep=max_sleep)
 
 
 def flapping_rf(pvname, n=3, max_sleep=0.001):
-    for i in range(n):
-        time.sleep(np.random.uniform(0, max_sleep))
-        StateMonitor.rf_turned_off(pvname=pvname)
-        StateMonitor.rf_turned_on(pvname=pvname)
+    flap(StateMonitor.rf_turned_off, StateMonitor.rf_turned_on, pvname, n=n, max_sleep=max_sleep)
 
 
 class TestStateMonitor(TestCase):
-    def test_daq_good(self):
-        """Test that any resolved problems do not stick with the state monitor."""
-        # Clear out previous state
+
+    @classmethod
+    def setUpClass(cls):
+        # "Restart" EPICS CA once so that PVs left over from other test modules don't report to the StateMonitor.
+        logger_level = logger.level
+        logger.setLevel(logging.CRITICAL)
+        epics.ca.clear_cache()
+        clear_cache()
+        logger.setLevel(logger_level)
+
+        # Build and connect one linac/zone/cavity for the whole class.  Connecting is the slow part, so tests share
+        # these and setUp puts back any PV values a previous test left changed.
+        cls.linac, cls.zone, cls.cav = get_linac_zone_cavity(update_gset_max=False)
+
+        # The test IOC starts in a good state, so remember these as the values to restore between tests
+        cls.good_values = {pv: pv.get(use_monitor=False) for pv in (cls.cav.rf_on, cls.cav.fsd, cls.zone.jt_stroke,
+                                                                     cls.linac.linac_pressure,
+                                                                     cls.linac.heater_margin)}
+
+    @classmethod
+    def tearDownClass(cls):
+        # Don't let the shared objects keep reporting to the StateMonitor after this class is done
+        clear_pv_callbacks(cls.linac, cls.zone, cls.cav)
+        StateMonitor.clear_state()
+
+    def setUp(self):
+        self.restore_pv_values()
         reinit_all()
 
-        linac, zone, cav = get_linac_zone_cavity()
+    @classmethod
+    def restore_pv_values(cls):
+        """Put back any of the shared PVs' values that a previous test changed and didn't restore.
+
+        The puts are issued together and waited on once, rather than waiting for each round trip in turn.
+        """
+        changed = [(pv.pvname, value) for pv, value in cls.good_values.items() if pv.get(use_monitor=False) != value]
+        if len(changed) > 0:
+            pvnames, values = zip(*changed)
+            epics.caput_many(list(pvnames), list(values), wait='all')
+
+    def test_daq_good(self):
+        """Test that any resolved problems do not stick with the state monitor."""
+        linac, zone, cav = self.linac, self.zone, self.cav
         pvs = [cav.rf_on.pvname]
         for i in range(2, 9):
             cav2 = Cavity.get_cavity(name='1L22-2', epics_name='adamc:R1M2', cavity_type='C100', length=0.7,
                                      bypassed=False, zone=zone, Q0=6e9, tuner_bad=False)
+            track(cav2)
             pvs.append(cav2.rf_on.pvname)
         n = 1000
         n_sleeps = [n, ] * len(pvs)
 
         self.assertTrue(StateMonitor.daq_good())
 
-        # This should run for 0.1 seconds
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            executor.map(flapping_pv, pvs, n_sleeps)
-            executor.map(flapping_rf, pvs, n_sleeps)
+        # This should run for about 0.5 seconds.  Wait on the futures directly rather than sleeping for a guessed amount
+        # of time, and call result() so that any exception raised in a worker fails the test.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
+            futures = [executor.submit(flapping_pv, pvname, n_sleep) for pvname, n_sleep in zip(pvs, n_sleeps)]
+            futures += [executor.submit(flapping_rf, pvname, n_sleep) for pvname, n_sleep in zip(pvs, n_sleeps)]
+            concurrent.futures.wait(futures)
+        for future in futures:
+            future.result()
 
-        # Sleep long enough for all of the flapping to have stopped.
-        time.sleep(n * 0.001 * 1.5)
         self.assertTrue(StateMonitor.daq_good())
 
     def test_daq_good_with_cavities(self):
         logger.setLevel(logging.INFO)
         logger.warning("Starting SM test")
 
-        # Clear out previous state
-        reinit_all()
-
-        # We have no PVs, so this should be good
-        self.assertTrue(StateMonitor.daq_good(), StateMonitor.output_state())
+        # The state was just cleared, so this should be good
+        self.assertTrue(StateMonitor.daq_good(), LazyMessage(StateMonitor.output_state))
 
-        # Create a cavity with supporting structure
-        linac, zone, cav = get_linac_zone_cavity()
+        linac, zone, cav = self.linac, self.zone, self.cav
 
         # The test IOC start with RF on.
         # 1. Verify daq_good == True
         # 2. Turn rf off, Verify daq_good == False
         # 3. Turn rf on, Verify daq_good == True
-        self.assertTrue(StateMonitor.daq_good(), StateMonitor.output_state())
+        self.assertTrue(StateMonitor.daq_good(), LazyMessage(StateMonitor.output_state))
 
         # Turn RF Off, verify that daq_good == False, then put it back
         cav.rf_on.put(0, wait=True)
-        time.sleep(0.01)  # Ensure the callback had a chance to run
-        self.assertFalse(StateMonitor.daq_good(), StateMonitor.output_state())
+        wait_for_daq_good(False)  # Ensure the callback had a chance to run
+        self.assertFalse(StateMonitor.daq_good(), LazyMessage(StateMonitor.output_state))
         cav.rf_on.put(1, wait=True)
-        time.sleep(0.01)  # Ensure the callback had a chance to run
-        self.assertTrue(StateMonitor.daq_good(), StateMonitor.output_state())
+        wait_for_daq_good(True)  # Ensure the callback had a chance to run
+        self.assertTrue(StateMonitor.daq_good(), LazyMessage(StateMonitor.output_state))
 
     def test_monitor_good(self):
-        # Clear out previous state
-        reinit_all()
-
-        # Create a cavity with supporting structure
-        linac, zone, cav = get_linac_zone_cavity()
+        linac, zone, cav = self.linac, self.zone, self.cav
 
         cav.rf_on.put(1, wait=True)
-        time.sleep(0.01)
+        wait_for_daq_good(True)
 
         start, end = StateMonitor.monitor(duration=0.5, user_input=False)
         if (end - start).total_seconds() > 0.6:
             self.fail("StateMonitor waited more than 0.6 while monitoring for 0.5 s")
 
     def test_monitor_cavity_fsd(self):
-        reinit_all()
-
-        # Create a cavity with supporting structure
-        linac, zone, cav = get_linac_zone_cavity()
+        linac, zone, cav = self.linac, self.zone, self.cav
 
         cav.fsd.put(256, wait=True)
-        time.sleep(0.01)
+        wait_for_daq_good(False)
         with self.assertRaises(Exception) as context:
             StateMonitor.monitor(duration=0, user_input=False)
         cav.fsd.put(768, wait=True)
-        time.sleep(0.01)
+        wait_for_daq_good(True)
         StateMonitor.monitor(duration=0, user_input=False)
 
     def test_monitor_bad(self):
-        # Clear out previous state
-        reinit_all()
-
-        # Create a cavity with supporting structure
-        linac, zone, cav = get_linac_zone_cavity()
+        linac, zone, cav = self.linac, self.zone, self.cav
 
         cav.rf_on.put(0, wait=True)
-        time.sleep(0.01)
+        wait_for_daq_good(False)
         with self.assertRaises(Exception) as context:
             StateMonitor.monitor(duration=0, user_input=False)
         cav.rf_on.put(1, wait=True)
 
+        # Make sure the RF problem has cleared, otherwise it, not the HV, would trip the check below
+        self.assertTrue(wait_for_daq_good(True), LazyMessage(StateMonitor.output_state))
+
         # Check that the StateMonitor sees bad HV
-        ndxe = NDXElectrometer(name="NDX1L05", epics_name=f"{prefix}NDX1L05", I400=1)
+        ndxe, = track(NDXElectrometer(name="NDX1L05", epics_name=f"{PREFIX}NDX1L05", I400=1))
         old_value = ndxe.hv_read_back.get(use_monitor=False)
         ndxe.hv_read_back.put(0, wait=True)
-        time.sleep(0.01)
+        wait_for_daq_good(False)
         with self.assertRaises(Exception) as context:
             StateMonitor.monitor(duration=0, user_input=False)
         ndxe.hv_read_back.put(old_value, wait=True)
+        self.assertTrue(wait_for_daq_good(True), LazyMessage(StateMonitor.output_state))
 
     def test_jt_valve_monitoring(self):
-        # Clear out previous state
-        reinit_all()
-
-        # Create a cavity with supporting structure
-        linac, zone, cav = get_linac_zone_cavity()
+        linac, zone, cav = self.linac, self.zone, self.cav
         old_value = zone.jt_stroke.get(use_monitor=False)
         zone.jt_stroke.put(95, wait=True)
 
-        time.sleep(0.05)
+        wait_for_daq_good(False)
         with self.assertRaises(Exception) as context:
             StateMonitor.check_state(user_input=False)
-        time.sleep(0.05)
         zone.jt_stroke.put(old_value, wait=True)
-        time.sleep(0.05)
+        wait_for_daq_good(True)
         StateMonitor.check_state(user_input=False)
 
     def test_linac_pressure_monitoring(self):
-        # Clear out previous state
-        reinit_all()
-
-        # Create a cavity with supporting structure
-        linac, zone, cav = get_linac_zone_cavity()
+        linac, zone, cav = self.linac, self.zone, self.cav
         old_value = linac.linac_pressure.value
 
         # Set too high
         linac.linac_pressure.put(0.04, wait=True)
-        time.sleep(0.01)
+        wait_for_daq_good(False)
 
         try:
             with self.assertRaises(Exception) as context:
@@ -189,41 +233,72 @@ class TestStateMonitor(TestCase):
 
             # Set OK
             linac.linac_pressure.put(0.0385, wait=True)
-            time.sleep(0.01)
+            wait_for_daq_good(True)
             StateMonitor.check_state(user_input=False)
 
             # Set too low
             linac.linac_pressure.put(0.037, wait=True)
-            time.sleep(0.01)
+            wait_for_daq_good(False)
 
             with self.assertRaises(Exception) as context:
                 StateMonitor.check_state(user_input=False)
         finally:
             linac.linac_pressure.put(old_value, wait=True)
 
-        time.sleep(0.01)
+        wait_for_daq_good(True)
         StateMonitor.check_state(user_input=False)
 
     def test_linac_heat_margin_monitoring(self):
-        # Clear out previous state
-        reinit_all()
-
-        # Create a cavity with supporting structure
-        linac, zone, cav = get_linac_zone_cavity()
+        linac, zone, cav = self.linac, self.zone, self.cav
         old_value = linac.heater_margin.value
         linac.heater_margin.put(1, wait=True)
-        time.sleep(0.05)
+        wait_for_daq_good(False)
 
         try:
             with self.assertRaises(Exception) as context:
                 StateMonitor.check_state(user_input=False)
         finally:
             linac.heater_margin.put(old_value, wait=True)
-        time.sleep(0.01)
+        wait_for_daq_good(True)
         StateMonitor.check_state(user_input=False)
 
-    def test_cb_threshold_bitshift_mask(self):
+    def test_wait_for(self):
+        # Already true, so this should not wait at all
+        self.assertTrue(StateMonitor.wait_for(StateMonitor.daq_good, timeout=0))
+
+        # Should wake up when the state changes from another thread
+        timer = threading.Timer(0.05, StateMonitor.rf_turned_off, kwargs={'pvname': 'test_pv'})
+        timer.start()
+        try:
+            self.assertTrue(StateMonitor.wait_for(lambda: not StateMonitor.daq_good(), timeout=2))
+        finally:
+            timer.join()
+
+        # Times out if the state never matches
+        self.assertFalse(StateMonitor.wait_for(StateMonitor.daq_good, timeout=0.01))
+        StateMonitor.rf_turned_on(pvname='test_pv')
+
+    def test_monitor_wakes_on_problem(self):
+        # A problem reported partway through the settle time should end the monitoring right away
+        timer = threading.Timer(0.05, StateMonitor.rf_turned_off, kwargs={'pvname': 'test_pv'})
+        start = time.monotonic()
+        timer.start()
+        try:
+            with self.assertRaises(RuntimeError):
+                StateMonitor.monitor(duration=5, user_input=False)
+        finally:
+            timer.join()
+            StateMonitor.rf_turned_on(pvname='test_pv')
+        self.assertLess(time.monotonic() - start, 1)
+
+
+class TestThresholdCallback(TestCase):
+    """Exercise the callbacks directly.  These don't need any PVs, so they skip the linac/zone/cavity setup."""
+
+    def setUp(self):
         reinit_all()
+
+    def test_cb_threshold_bitshift_mask(self):
         cb = get_threshold_cb(low=0, high=0, bitshift=2, mask=1)
 
         # Should be no alert
@@ -241,3 +316,17 @@ class TestStateMonitor(TestCase):
         # Should be no alert
         cb(pvname='test_pv', value=0)
         StateMonitor.check_state(user_input=False)
+
+    def test_hv_read_back_cb_after_clear_state(self):
+        cb = get_hv_read_back_cb(target_hv=1000)
+
+        cb(pvname='test_hv', value=0)
+        self.assertFalse(StateMonitor.daq_good())
+
+        # An HV readback that is still bad must be reported again after the state is cleared
+        StateMonitor.clear_state()
+        cb(pvname='test_hv', value=0)
+        self.assertFalse(StateMonitor.daq_good(), LazyMessage(StateMonitor.output_state))
+
+        cb(pvname='test_hv', value=1000)
+        self.assertTrue(StateMonitor.daq_good(), LazyMessage(StateMonitor.output_state))